@@ -0,0 +1,220 @@
+import json
+import os
+import pickle
+
+import aiofiles
+
+# Versions tried for WMS GetCapabilities requests. None sends no version, in which case the server should answer
+# with the highest version it supports (WMS Specification Section 6.2 Version numbering and negotiation).
+WMS_VERSIONS = [None, "1.3.0", "1.1.1", "1.1.0", "1.0.0"]
+
+
+def wms_capabilities_variants():
+    """All variants (parameter_uppercase, version) of a WMS GetCapabilities request in the order they are tried"""
+    return [
+        (parameter_uppercase, version)
+        for parameter_uppercase in [True, False]
+        for version in WMS_VERSIONS
+    ]
+
+
+class WmsLayer:
+    """Layer of a WMS GetCapabilities document
+
+    crs is a frozenset and styles a dict mapping style names to {"Name": .., "Title": ..}. Layers without
+    own CRS or styles share the objects of their parent layer, thus neither must be modified.
+    """
+
+    __slots__ = ("name", "title", "abstract", "crs", "styles", "bbox")
+
+    def __init__(self, crs=frozenset(), styles=None, bbox=None):
+        self.name = None
+        self.title = None
+        self.abstract = None
+        self.crs = crs
+        self.styles = {} if styles is None else styles
+        self.bbox = bbox
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in WmsLayer.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(WmsLayer.__slots__, state):
+            setattr(self, slot, value)
+
+
+class WmsLayers:
+    """Named layers of a WMS indexed by their name and their case folded name
+
+    Behaves like a read only dict mapping layer names to WmsLayer.
+    """
+
+    __slots__ = ("layers", "folded")
+
+    def __init__(self):
+        self.layers = {}
+        self.folded = {}
+
+    def add(self, layer: WmsLayer):
+        self.layers[layer.name] = layer
+        names = self.folded.setdefault(layer.name.casefold(), [])
+        if layer.name not in names:
+            names.append(layer.name)
+
+    def find_case_insensitive(self, name):
+        """Names of the layers whose name only differs in case from name"""
+        return [
+            layer_name
+            for layer_name in self.folded.get(name.casefold(), [])
+            if not layer_name == name
+        ]
+
+    def __contains__(self, name):
+        return name in self.layers
+
+    def __getitem__(self, name):
+        return self.layers[name]
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def __len__(self):
+        return len(self.layers)
+
+    def keys(self):
+        return self.layers.keys()
+
+    def __getstate__(self):
+        return self.layers
+
+    def __setstate__(self, state):
+        self.layers = {}
+        self.folded = {}
+        for layer in state.values():
+            self.add(layer)
+
+
+class CrsSets:
+    """Intern table of CRS sets, such that layers with the same CRS share one frozenset"""
+
+    def __init__(self):
+        self.sets = {}
+
+    def get(self, crs):
+        crs = frozenset(crs)
+        return self.sets.setdefault(crs, crs)
+
+
+class VariantStore:
+    """Persistent store of the GetCapabilities request variant that worked for each WMS endpoint
+
+    Variants are stored as (parameter_uppercase, version). As long as no path is set with load(), variants are
+    only remembered for the current run.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.variants = {}
+        self.used = set()
+
+    def load(self, path):
+        """Load variants from the JSON file path"""
+        self.path = path
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.variants = {
+                        endpoint: tuple(variant)
+                        for endpoint, variant in json.load(f).items()
+                    }
+            except Exception as e:
+                print("Could not load variants {}: {}".format(path, str(e)))
+                self.variants = {}
+
+    def save(self):
+        """Write the variants of the endpoints used during this run to disk"""
+        if self.path is None:
+            return
+        variants = {
+            endpoint: list(variant)
+            for endpoint, variant in self.variants.items()
+            if endpoint in self.used
+        }
+        with open(self.path, "w") as f:
+            json.dump(variants, f, indent=1)
+
+    def get(self, endpoint):
+        """Return the variant that worked last time for endpoint or None"""
+        self.used.add(endpoint)
+        return self.variants.get(endpoint)
+
+    def put(self, endpoint, variant):
+        self.used.add(endpoint)
+        self.variants[endpoint] = tuple(variant)
+
+    def order(self, endpoint, variants):
+        """Order variants such that the variant that worked last time for endpoint comes first"""
+        known = self.get(endpoint)
+        if known is None or known not in variants:
+            return list(variants)
+        return [known] + [variant for variant in variants if not variant == known]
+
+
+# Increment if the output of a parser changes, such that parses of previous runs are not used anymore
+PARSED_STORE_VERSION = 2
+
+
+class ParsedStore:
+    """Persistent store of parsed capabilities keyed by the sha256 digest of the document and the parser name
+
+    Documents that did not change since the previous run are not parsed again. Each entry is stored pickled
+    in a separate file. Entries not used during a run are removed by save(). As long as no path is set with
+    load(), the store is disabled.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.used = set()
+
+    def load(self, path):
+        """Use directory path for the store. Created if it does not exist."""
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, digest, name):
+        return os.path.join(
+            self.path, "{}-{}-{}.pickle".format(name, PARSED_STORE_VERSION, digest)
+        )
+
+    async def get(self, digest, name):
+        """Return the stored entry (parsed, exception) or None"""
+        if self.path is None or digest is None:
+            return None
+        path = self.entry_path(digest, name)
+        self.used.add(path)
+        try:
+            async with aiofiles.open(path, mode="rb") as f:
+                return pickle.loads(await f.read())
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print("Could not load parsed capabilities {}: {}".format(path, str(e)))
+            return None
+
+    async def put(self, digest, name, entry):
+        """Store the entry (parsed, exception)"""
+        if self.path is None or digest is None:
+            return
+        path = self.entry_path(digest, name)
+        self.used.add(path)
+        async with aiofiles.open(path, mode="wb") as f:
+            await f.write(pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def save(self):
+        """Remove entries not used during this run"""
+        if self.path is None:
+            return
+        for filename in os.listdir(self.path):
+            path = os.path.join(self.path, filename)
+            if path not in self.used:
+                os.unlink(path)
@@ -0,0 +1,205 @@
+import asyncio
+import time
+from collections import namedtuple
+
+HostLimit = namedtuple("HostLimit", ["concurrency", "rate", "burst"])
+"""Request limits of a host
+
+concurrency: Maximal number of concurrent requests
+rate: Average number of requests per second. None for no rate limit.
+burst: Number of requests that can be sent at once before the rate applies
+"""
+
+# Requests are not paced by default, only their concurrency is limited
+DEFAULT_HOST_LIMIT = HostLimit(concurrency=2, rate=None, burst=2)
+
+# Limits for specific hosts, e.g. to pace requests to hosts that throttle. A host also matches all its subdomains.
+host_limit_overrides = {
+    # "wms.geo.admin.ch": HostLimit(concurrency=4, rate=8.0, burst=4),
+}
+
+
+class TokenBucket:
+    """Token bucket to pace requests to rate requests per second"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        if self.rate is None:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HostLimiter:
+    """Limits the number of concurrent requests and paces the requests to a host
+
+    Usage:
+        async with limiter:
+            ... send request
+    """
+
+    def __init__(self, limit: HostLimit):
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit.concurrency)
+        self.bucket = TokenBucket(limit.rate, limit.burst)
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        try:
+            await self.bucket.acquire()
+        except:
+            self.semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.semaphore.release()
+
+
+class HostLimiters:
+    """Registry of the HostLimiter of each host"""
+
+    def __init__(self, default=DEFAULT_HOST_LIMIT, overrides=None):
+        self.default = default
+        self.overrides = host_limit_overrides if overrides is None else overrides
+        self.limiters = {}
+
+    def get_limit(self, host):
+        """Find limit of host. Overrides of parent domains apply to subdomains."""
+        host = host.lower()
+        parts = host.split(".")
+        for i in range(len(parts)):
+            domain = ".".join(parts[i:])
+            if domain in self.overrides:
+                return self.overrides[domain]
+        return self.default
+
+    def get(self, parsed_url):
+        """Return the HostLimiter of the netloc of an url parsed by urlparse()"""
+        netloc = parsed_url.netloc
+        if netloc not in self.limiters:
+            host = parsed_url.hostname or netloc
+            self.limiters[netloc] = HostLimiter(self.get_limit(host))
+        return self.limiters[netloc]
+
+
+# Number of consecutive connection failures after which the circuit of a host opens
+CIRCUIT_BREAKER_THRESHOLD = 3
+# Seconds after which a host with open circuit is probed again
+CIRCUIT_BREAKER_COOLDOWN = 120.0
+
+
+class CircuitBreaker:
+    """Short-circuit requests to a host that repeatedly failed on the connection level
+
+    The circuit opens after threshold consecutive connection failures (timeouts, refused connections, ...).
+    While it is open, requests are refused immediately. After cooldown seconds a single request is let through
+    to probe the host, concurrent requests wait for its outcome. A successful probe closes the circuit, a failed
+    one opens it for another cooldown.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self, threshold=CIRCUIT_BREAKER_THRESHOLD, cooldown=CIRCUIT_BREAKER_COOLDOWN
+    ):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.last_failure = None
+        self.opened = None
+        self.probe_done = None
+        # Task sending the probe while the circuit is half open
+        self.probe_owner = None
+
+    def is_open(self):
+        """Return whether requests are currently refused"""
+        return (
+            self.state == CircuitBreaker.OPEN
+            and time.monotonic() - self.opened < self.cooldown
+        )
+
+    async def allow(self):
+        """Return whether a request may be sent
+
+        A caller that is allowed to send a request must report its outcome with record_success() or
+        record_failure(), and call release_probe() once it is done. If the circuit is half open, the calling task
+        owns the probe.
+        """
+        while True:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN:
+                if time.monotonic() - self.opened < self.cooldown:
+                    return False
+                self.state = CircuitBreaker.HALF_OPEN
+                self.probe_done = asyncio.Event()
+                self.probe_owner = asyncio.current_task()
+                return True
+            # Wait for the outcome of the probe
+            await self.probe_done.wait()
+
+    def record_success(self):
+        self.failures = 0
+        self.last_failure = None
+        if self.state == CircuitBreaker.HALF_OPEN:
+            self.probe_done.set()
+            self.probe_owner = None
+        self.state = CircuitBreaker.CLOSED
+
+    def record_failure(self, reason):
+        self.failures += 1
+        self.last_failure = reason
+        if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.threshold:
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self.probe_done.set()
+                self.probe_owner = None
+            self.state = CircuitBreaker.OPEN
+            self.opened = time.monotonic()
+
+    def release_probe(self):
+        """Release the probe of the calling task if its outcome was not recorded
+
+        E.g. if the probe was cancelled or failed with an error that is not a connection failure. The circuit
+        stays open, but the next request is let through as new probe. Only the task owning the probe releases it,
+        calls of other tasks are ignored.
+        """
+        if (
+            self.state == CircuitBreaker.HALF_OPEN
+            and self.probe_owner is asyncio.current_task()
+        ):
+            self.state = CircuitBreaker.OPEN
+            self.opened = time.monotonic() - self.cooldown
+            self.probe_done.set()
+            self.probe_owner = None
+
+
+class CircuitBreakers:
+    """Registry of the CircuitBreaker of each host"""
+
+    def __init__(self):
+        self.breakers = {}
+
+    def get(self, netloc):
+        if netloc not in self.breakers:
+            self.breakers[netloc] = CircuitBreaker()
+        return self.breakers[netloc]
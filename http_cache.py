@@ -0,0 +1,237 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import aiofiles
+
+
+def get_body_size(status, response_headers):
+    """Size of the complete body of a response in bytes, from Content-Range for 206 responses
+
+    Returns None if the size is unknown.
+    """
+    if status == 206:
+        total = response_headers.get("Content-Range", "").rpartition("/")[2]
+    else:
+        total = response_headers.get("Content-Length", "")
+    if total.isdigit():
+        return int(total)
+    return None
+
+
+class HttpCache:
+    """Persistent cache of HTTP responses shared between watchdog runs
+
+    For every cached url the validators (ETag, Last-Modified) and the sha256 hash of the body are stored in an
+    index file, the bodies themselves are stored in separate files named after their hash. On the next run
+    get_url() sends a conditional request with the stored validators and treats a 304 response as cache hit.
+
+    As long as no path is set with load(), the cache is disabled.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.entries = {}
+        self.used = set()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, "index.json")
+
+    def body_path(self, digest):
+        return os.path.join(self.path, "bodies", digest)
+
+    def load(self, path):
+        """Load cache index from path
+
+        Parameters
+        ----------
+        path : str
+            Directory of the cache. Created if it does not exist.
+        """
+        self.path = path
+        os.makedirs(os.path.join(path, "bodies"), exist_ok=True)
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path) as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                print(
+                    "Could not load HTTP cache {}: {}".format(self.index_path, str(e))
+                )
+                self.entries = {}
+        print("Loaded {} HTTP cache entries".format(len(self.entries)))
+
+    def save(self):
+        """Write cache index to disk
+
+        Entries of urls that were not requested during this run are dropped together with bodies no longer
+        referenced.
+        """
+        if not self.enabled:
+            return
+        self.entries = {
+            url: entry for url, entry in self.entries.items() if url in self.used
+        }
+        with open(self.index_path, "w") as f:
+            json.dump(self.entries, f)
+
+        referenced = {
+            entry["sha256"] for entry in self.entries.values() if "sha256" in entry
+        }
+        for digest in os.listdir(os.path.join(self.path, "bodies")):
+            if digest not in referenced:
+                os.unlink(self.body_path(digest))
+
+    def get(self, url, with_text=False):
+        """Return cache entry of url or None
+
+        Parameters
+        ----------
+        url : str
+            Requested url
+        with_text : bool
+            Only return entries that include a body
+        """
+        if not self.enabled:
+            return None
+        self.used.add(url)
+        entry = self.entries.get(url)
+        if entry is None or (with_text and "sha256" not in entry):
+            return None
+        return entry
+
+    def conditional_headers(self, url, with_text=False):
+        """Headers to revalidate a cached response of url"""
+        headers = {}
+        entry = self.get(url, with_text)
+        if entry is not None:
+            if "etag" in entry:
+                headers["If-None-Match"] = entry["etag"]
+            if "last_modified" in entry:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    async def read_digest(self, digest):
+        """Read a stored body by its sha256 digest. Returns None if no such body is stored."""
+        if not self.enabled:
+            return None
+        try:
+            async with aiofiles.open(self.body_path(digest), mode="rb") as f:
+                return await f.read()
+        except OSError:
+            return None
+
+    async def read_body(self, url):
+        """Read cached body of url
+
+        Returns
+        -------
+        bytes or None:
+            The body or None if the body is not available.
+        """
+        entry = self.get(url, with_text=True)
+        if entry is None:
+            return None
+        try:
+            async with aiofiles.open(self.body_path(entry["sha256"]), mode="rb") as f:
+                body = await f.read()
+        except OSError:
+            return None
+        if hashlib.sha256(body).hexdigest() != entry["sha256"]:
+            return None
+        return body
+
+    async def store(self, url, status, response_headers, body=None, partial=False):
+        """Store a response
+
+        Only successful responses with at least one validator are stored, as only these can be revalidated.
+
+        Parameters
+        ----------
+        url : str
+            Requested url
+        status : int
+            HTTP status code
+        response_headers : Mapping
+            Headers of the response
+        body : bytes
+            Body of the response, None for requests where only the status is of interest
+        partial : bool
+            Whether body is only the start of the body. url must then be a key used only for such requests.
+        """
+        if not self.enabled:
+            return
+        self.used.add(url)
+        previous = self.entries.get(url)
+        if body is None and previous is not None and "sha256" in previous:
+            # Status only requests do not replace a cached body of the same url
+            return
+        # 206 Partial Content is only stored for requests where the full body is not of interest
+        if not (status == 200 or (status == 206 and (body is None or partial))):
+            self.entries.pop(url, None)
+            return
+
+        entry = {"status": status}
+        if "ETag" in response_headers:
+            entry["etag"] = response_headers["ETag"]
+        if "Last-Modified" in response_headers:
+            entry["last_modified"] = response_headers["Last-Modified"]
+        if "etag" not in entry and "last_modified" not in entry:
+            self.entries.pop(url, None)
+            return
+        if "Content-Type" in response_headers:
+            entry["content_type"] = response_headers["Content-Type"]
+
+        if body is not None:
+            digest = hashlib.sha256(body).hexdigest()
+            body_path = self.body_path(digest)
+            if not os.path.exists(body_path):
+                async with aiofiles.open(body_path, mode="wb") as f:
+                    await f.write(body)
+            entry["sha256"] = digest
+            if partial:
+                entry["size"] = get_body_size(status, response_headers)
+        self.entries[url] = entry
+
+
+class BodyCache:
+    """In memory LRU cache of response bodies keyed by their sha256 digest
+
+    The total size of the cached bodies is kept below max_bytes by evicting the least recently used bodies.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.bodies = OrderedDict()
+
+    def get(self, digest):
+        """Return body or None if it is not cached"""
+        body = self.bodies.get(digest)
+        if body is not None:
+            self.bodies.move_to_end(digest)
+        return body
+
+    def put(self, digest, body):
+        if digest in self.bodies:
+            self.bodies.move_to_end(digest)
+            return
+        if len(body) > self.max_bytes:
+            return
+        self.bodies[digest] = body
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, evicted = self.bodies.popitem(last=False)
+            self.size -= len(evicted)
+
+    def evict(self, digest):
+        """Remove body from the cache, e.g. once it is parsed"""
+        body = self.bodies.pop(digest, None)
+        if body is not None:
+            self.size -= len(body)
@@ -1,22 +1,49 @@
 import asyncio
+import codecs
 import datetime
+from email.message import Message
+import functools
 import glob
+import hashlib
 import json
 import os
 from collections import namedtuple
-from io import StringIO
 import ssl
+import sys
 import aiofiles
 import aiohttp
+import charset_normalizer
 import validators
-from shapely.geometry import shape, Point, box
-import mercantile
+import numpy as np
+import shapely
+from shapely.geometry import shape
 from owslib.wmts import WebMapTileService
 import warnings
-import re
+import time
 from aiohttp import ClientSession
 from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
 import xml.etree.ElementTree as ET
+from capabilities import (
+    CrsSets,
+    ParsedStore,
+    VariantStore,
+    WmsLayer,
+    WmsLayers,
+    wms_capabilities_variants,
+)
+from http_cache import BodyCache, HttpCache, get_body_size
+from hosts import CircuitBreakers, HostLimiters
+from scheduler import CpuExecutor, interleave, probe_in_order, run_jobs
+from tiles import (
+    GETMAP_PROJECTIONS,
+    TileFingerprints,
+    TileUrlTemplate,
+    render_getmap_bbox,
+    sample_points,
+    tile_coordinates,
+    validate_tile,
+)
+from tracing import RequestTracer, trace_tags
 
 imagery_ignore = {
     "SG-2018-WMS": "WMS server does not advertise layer OP_SG (2020-8-23)",
@@ -41,13 +68,256 @@ def create_result(status, message):
     return {"status": status, "message": message}
 
 
+def decode_body(body, encoding):
+    """Decode body with encoding. Returns the raw bytes if it can not be decoded."""
+    if encoding is None:
+        return body
+    try:
+        return body.decode(encoding)
+    except:
+        return body
+
+
+def guess_encoding(content_type, body):
+    """Encoding of a response body, determined the same way as by ClientResponse.get_encoding()
+
+    Parameters
+    ----------
+    content_type : str
+        Content-Type header of the response, None if not present
+    body : bytes
+        Body of the response
+    """
+    message = Message()
+    if content_type is not None:
+        message["Content-Type"] = content_type
+    encoding = message.get_content_charset()
+    if encoding is not None:
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            encoding = None
+    if encoding is None:
+        if message.get_content_type() in {"application/json", "application/rdap+json"}:
+            encoding = "utf-8"
+        else:
+            encoding = charset_normalizer.detect(body)["encoding"]
+    if not encoding:
+        encoding = "utf-8"
+    return encoding
+
+
+class BodyLimitExceeded(Exception):
+    pass
+
+
+async def read_body(response, url, max_size):
+    """Read the body of response chunk by chunk
+
+    Raises BodyLimitExceeded if the body is larger than max_size or if, after MIN_THROUGHPUT_GRACE seconds, less
+    than MIN_BODY_THROUGHPUT bytes per second were received.
+    """
+    if response.content_length is not None and response.content_length > max_size:
+        raise BodyLimitExceeded(
+            "Response size of {} bytes exceeds limit of {} bytes for: {}".format(
+                response.content_length, max_size, url
+            )
+        )
+
+    chunks = []
+    size = 0
+    start = time.monotonic()
+    while True:
+        # Wait for the next chunk at most until the throughput would fall below the minimum
+        deadline = start + max(MIN_THROUGHPUT_GRACE, (size + 1) / MIN_BODY_THROUGHPUT)
+        try:
+            chunk = await asyncio.wait_for(
+                response.content.readany(), max(deadline - time.monotonic(), 0.0)
+            )
+        except asyncio.TimeoutError:
+            raise BodyLimitExceeded(
+                "Response body slower than {} bytes/s ({} bytes in {:.1f} s) for: {}".format(
+                    MIN_BODY_THROUGHPUT, size, time.monotonic() - start, url
+                )
+            )
+        if len(chunk) == 0:
+            break
+        size += len(chunk)
+        if size > max_size:
+            raise BodyLimitExceeded(
+                "Response body exceeds limit of {} bytes for: {}".format(max_size, url)
+            )
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+async def read_prefix(response, size):
+    """Read the first size bytes of the body of response
+
+    The connection is closed if the body is longer, such that the rest is not transferred.
+    """
+    data = b""
+    while len(data) < size:
+        chunk = await response.content.read(size - len(data))
+        if len(chunk) == 0:
+            break
+        data += chunk
+    if not response.content.at_eof():
+        response.close()
+    return data
+
+
+def canonical_url(url):
+    """Canonical form of url used as cache key
+
+    Scheme and host are lower cased, default ports and fragments are removed.
+    """
+    o = urlparse(url)
+    scheme = o.scheme.lower()
+    netloc = o.netloc.rpartition("@")[-1].lower()
+    if (scheme, o.port) in {("http", 80), ("https", 443)}:
+        netloc = netloc.rpartition(":")[0]
+    userinfo = o.netloc.rpartition("@")[0]
+    if len(userinfo) > 0:
+        netloc = "{}@{}".format(userinfo, netloc)
+    path = o.path if len(o.path) > 0 else "/"
+    return urlunparse((scheme, netloc, path, o.params, o.query, ""))
+
+
+def get_headers_key(headers):
+    """Digest of request headers used in cache keys, None if there are no headers"""
+    if not headers:
+        return None
+    return hashlib.sha256(json.dumps(sorted(headers.items())).encode()).hexdigest()
+
+
+def get_cache_key(key, mode, kind="default", headers=None):
+    """Key of response_cache for the canonical url key, requested in mode with headers
+
+    kind only matters for text requests, as it limits the size of the body.
+    """
+    return key, mode, kind if mode == "text" else None, get_headers_key(headers)
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one call
+
+    All callers of do() with the same key await the same task. The task is only cancelled when all its
+    callers are cancelled.
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    def __contains__(self, key):
+        return key in self.calls
+
+    async def do(self, key, coro_factory):
+        if key not in self.calls:
+            task = asyncio.create_task(coro_factory())
+            call = self.calls[key] = {"task": task, "waiters": 0}
+
+            def done(_):
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+
+            task.add_done_callback(done)
+        call = self.calls[key]
+        call["waiters"] += 1
+        try:
+            return await asyncio.shield(call["task"])
+        except asyncio.CancelledError:
+            if not call["task"].done() and call["waiters"] == 1:
+                call["task"].cancel()
+            raise
+        finally:
+            call["waiters"] -= 1
+
+
 RequestResult = namedtuple(
-    "RequestResultCache", ["status", "text", "exception"], defaults=[None, None, None]
+    "RequestResultCache",
+    ["status", "text", "exception", "digest", "encoding", "content_type", "size"],
+    defaults=[None, None, None, None, None, None, None],
 )
 
+WmsEndpoint = namedtuple("WmsEndpoint", ["url", "version", "exceptions"])
+"""Outcome of a GetCapabilities negotiation
+
+url: GetCapabilities url that worked, None if no variant worked
+version: WMS version of url for messages
+exceptions: Messages of the variants that failed
+"""
+
+# Parameters of WMS GetMap requests that are not passed on to GetCapabilities requests
+WMS_GETMAP_PARAMETERS = {
+    "version",
+    "request",
+    "layers",
+    "bbox",
+    "width",
+    "height",
+    "format",
+    "crs",
+    "srs",
+    "styles",
+    "transparent",
+    "dpi",
+    "map_resolution",
+    "format_options",
+    "bgcolor",
+    "exceptions",
+    "time",
+    "elevation",
+    "tiled",
+}
+
+# Maximal number of sources processed at the same time
+MAX_WORKERS = 64
+# Maximal number of requests in flight over all hosts
+MAX_INFLIGHT_REQUESTS = 32
+# Number of bytes requested by test_url if a server does not support HEAD requests and by test_tile_url
+PROBE_RANGE_BYTES = 1024
+# Maximal size of response bodies in bytes per kind of request
+MAX_BODY_SIZES = {
+    "capabilities": 32 * 1024 * 1024,
+    "default": 8 * 1024 * 1024,
+}
+# Minimal throughput in bytes per second while reading a response body, checked after MIN_THROUGHPUT_GRACE seconds
+MIN_BODY_THROUGHPUT = 16 * 1024
+MIN_THROUGHPUT_GRACE = 5.0
+# Memory budget in bytes for response bodies kept in memory
+MAX_BODY_CACHE_BYTES = 64 * 1024 * 1024
+# Number of points of the source geometry at which tiles of TMS sources are tested
+TMS_SAMPLE_POINTS = 4
+# Width and height in pixels of the image requested by the GetMap test of WMS sources and the zoom level whose
+# resolution it has, unless the source restricts its zoom levels
+WMS_GETMAP_SIZE = 64
+WMS_GETMAP_ZOOM = 16
+# Geometries with more vertices are simplified before computing the area outside of layer bounding boxes, with a
+# tolerance relative to the extent of the geometry
+BBOX_SIMPLIFY_VERTICES = 1000
+BBOX_SIMPLIFY_TOLERANCE = 0.001
+
+# Compact results without text. Bodies are kept in body_cache, parsed bodies in parsed_cache.
 response_cache = {}
-domain_locks = {}
-domain_lock = asyncio.Lock()
+body_cache = BodyCache(MAX_BODY_CACHE_BYTES)
+parsed_cache = {}
+# Parses of whole documents in progress by (digest, name of parser), see get_parsed_url()
+reparses = SingleFlight()
+parsed_store = ParsedStore()
+http_cache = HttpCache()
+wms_variants = VariantStore()
+request_tracer = RequestTracer()
+cpu_executor = CpuExecutor()
+tile_fingerprints = TileFingerprints()
+timings_report = "web/timings.json"
+host_limiters = HostLimiters()
+circuit_breakers = CircuitBreakers()
+inflight_requests = asyncio.Semaphore(MAX_INFLIGHT_REQUESTS)
+inflight = SingleFlight()
+# Outcome of successful GetCapabilities negotiations per WMS endpoint and headers, see get_wms_capabilities()
+wms_endpoints = {}
+wms_negotiations = SingleFlight()
 
 # We ignore SSL issues as best we can
 # See https://github.com/aio-libs/aiohttp/issues/7018
@@ -69,52 +339,370 @@ def get_http_headers(source):
     return headers
 
 
-async def get_url(url: str, session: ClientSession, with_text=False, headers=None):
-    """Ensure that only one request is sent to a domain at one point in time and that the same url is not
+async def request_url(
+    url: str,
+    cache_key: str,
+    session: ClientSession,
+    with_text=False,
+    headers=None,
+    method="GET",
+    kind="default",
+    trace=None,
+    breaker=None,
+    max_bytes=None,
+):
+    """Send a request to url
+
+    Bodies are limited to MAX_BODY_SIZES[kind] bytes. With max_bytes, only the first max_bytes bytes of the body
+    are requested with a Range header and read. trace is passed as trace_request_ctx to the request.
+    Connection level failures and received responses are reported to the CircuitBreaker breaker.
+
+    Responses stored in the persistent http_cache of a previous run are revalidated with a conditional request.
+
+    Returns
+    -------
+    RequestResult:
+        Result without text
+    bytes:
+        The body, None if neither with_text nor max_bytes is given
+    """
+    partial = max_bytes is not None
+    with_text = with_text or partial
+    conditional_headers = {}
+    cached_body = None
+    if with_text:
+        cached_body = await http_cache.read_body(cache_key)
+        if cached_body is not None:
+            conditional_headers = http_cache.conditional_headers(cache_key, True)
+    else:
+        conditional_headers = http_cache.conditional_headers(cache_key)
+    request_headers = dict(headers or {})
+    request_headers.update(conditional_headers)
+    if partial:
+        request_headers["Range"] = "bytes=0-{}".format(max_bytes - 1)
+
+    try:
+        print("{} {}".format(method, url), headers)
+        async with session.request(
+            method,
+            url=url,
+            ssl=nossl_sslcontext,
+            headers=request_headers,
+            trace_request_ctx=trace,
+        ) as response:
+            if breaker is not None:
+                breaker.record_success()
+            status = response.status
+            if status == 304 and len(conditional_headers) > 0:
+                print("Not modified {}".format(url))
+                entry = http_cache.get(cache_key, with_text)
+                status = entry["status"]
+                content_type = entry.get("content_type")
+                if with_text:
+                    digest = hashlib.sha256(cached_body).hexdigest()
+                    result = RequestResult(
+                        status=status,
+                        digest=digest,
+                        content_type=content_type,
+                        size=entry.get("size"),
+                    )
+                    return result, cached_body
+                return RequestResult(status=status, content_type=content_type), None
+            content_type = response.headers.get("Content-Type")
+            if partial:
+                body = await read_prefix(response, max_bytes)
+                await http_cache.store(
+                    cache_key, status, response.headers, body, partial=True
+                )
+                digest = hashlib.sha256(body).hexdigest()
+                result = RequestResult(
+                    status=status,
+                    digest=digest,
+                    content_type=content_type,
+                    size=get_body_size(status, response.headers),
+                )
+                return result, body
+            elif with_text:
+                body = await read_body(response, url, MAX_BODY_SIZES[kind])
+                await http_cache.store(cache_key, status, response.headers, body)
+                digest = hashlib.sha256(body).hexdigest()
+                result = RequestResult(
+                    status=status,
+                    digest=digest,
+                    content_type=content_type,
+                )
+                return result, body
+            else:
+                await http_cache.store(cache_key, status, response.headers)
+                return RequestResult(status=status, content_type=content_type), None
+    except asyncio.TimeoutError:
+        if breaker is not None:
+            breaker.record_failure("Timeout")
+        return RequestResult(exception="Timeout for: {}".format(url)), None
+    except aiohttp.ClientConnectionError as e:
+        print("Error for: {} ({})".format(url, str(e)))
+        if breaker is not None:
+            breaker.record_failure(str(e))
+        result = RequestResult(exception="Exception {} for: {}".format(str(e), url))
+        return result, None
+    except BodyLimitExceeded as e:
+        print("Error for: {} ({})".format(url, str(e)))
+        return RequestResult(exception=str(e)), None
+    except Exception as e:
+        print("Error for: {} ({})".format(url, str(e)))
+        result = RequestResult(exception="Exception {} for: {}".format(str(e), url))
+        return result, None
+
+
+async def load_body(result: RequestResult):
+    """Load the body of a compact result from body_cache or the persistent http_cache
+
+    Returns None if the body is no longer available.
+    """
+    body = body_cache.get(result.digest)
+    if body is None:
+        body = await http_cache.read_digest(result.digest)
+        if body is None or not hashlib.sha256(body).hexdigest() == result.digest:
+            return None
+        body_cache.put(result.digest, body)
+    return body
+
+
+async def get_url(
+    url: str,
+    session: ClientSession,
+    with_text=False,
+    headers=None,
+    method="GET",
+    kind="default",
+    decode=True,
+    probe=False,
+):
+    """Ensure that the requests to a domain respect its HostLimit and that the same url is not
     queried more than once.
+
+    Results are cached by canonical url, headers and for text requests kind, see get_cache_key(). Concurrent
+    calls for the same url share one request. A response
+    requested with text can answer a request for the status only, and a GET response a HEAD request, but not
+    vice versa.
+
+    kind selects the maximal body size from MAX_BODY_SIZES. With decode=False, text holds the raw bytes of the
+    body. With probe=True, only the first PROBE_RANGE_BYTES bytes of the body are requested and text holds them
+    as raw bytes.
+
+    Requests to hosts whose CircuitBreaker is open fail immediately and are not cached.
+
+    Only compact results are kept in response_cache, the bodies are kept in the size-bounded body_cache. If a
+    body was evicted and is not available in the persistent http_cache, the url is requested again.
     """
-    o = urlparse(url)
+    try:
+        o = urlparse(url)
+        key = canonical_url(url)
+    except ValueError as e:
+        # E.g. invalid port
+        return RequestResult(exception="Could not parse URL: {} ({})".format(url, e))
     if len(o.netloc) == 0:
         return RequestResult(exception="Could not parse URL: {}".format(url))
 
-    async with domain_lock:
-        if o.netloc not in domain_locks:
-            domain_locks[o.netloc] = asyncio.Lock()
-        lock = domain_locks[o.netloc]
+    http_cache_key = key
+    headers_key = get_headers_key(headers)
+    if headers_key is not None:
+        # Responses to requests with different headers are stored separately in the http_cache
+        http_cache_key = "{}#{}".format(key, headers_key)
+    if probe:
+        method = "GET"
+        modes = ["probe"]
+        # Partial bodies are stored separately from full bodies in the http_cache
+        http_cache_key = http_cache_key + "#probe"
+        decode = False
+    elif with_text:
+        method = "GET"
+        modes = ["text"]
+    elif method == "HEAD":
+        modes = ["HEAD", "GET", "text"]
+    else:
+        modes = [method, "text"]
+    cache_keys = [get_cache_key(key, mode, kind, headers) for mode in modes]
 
-    async with lock:
-        if url not in response_cache:
-            try:
-                print("GET {}".format(url), headers)
-                async with session.get(url=url, ssl=nossl_sslcontext, headers=headers) as response:
-                    status = response.status
-                    if with_text:
-                        try:
-                            text = await response.text()
-                        except:
-                            text = await response.read()
-                        response_cache[url] = RequestResult(status=status, text=text)
-                    else:
-                        response_cache[url] = RequestResult(status=status)
-            except asyncio.TimeoutError:
-                response_cache[url] = RequestResult(
-                    exception="Timeout for: {}".format(url)
+    def prepare(result):
+        """Decode the raw body of a result if requested
+
+        The encoding is only determined here, as most bodies are parsed from the raw bytes.
+        """
+        if decode and isinstance(result.text, bytes):
+            encoding = guess_encoding(result.content_type, result.text)
+            text = decode_body(result.text, encoding)
+            if isinstance(text, bytes):
+                encoding = None
+            return result._replace(text=text, encoding=encoding)
+        return result
+
+    for cache_key in cache_keys:
+        if cache_key in response_cache:
+            result = response_cache[cache_key]
+            if (with_text or probe) and result.digest is not None:
+                body = await load_body(result)
+                if body is None:
+                    print("Evicted {}".format(url))
+                    del response_cache[cache_key]
+                    break
+                result = result._replace(text=body)
+            print("Cached {}".format(url))
+            return prepare(result)
+    for cache_key in cache_keys:
+        if cache_key in inflight:
+            print("Waiting for {}".format(url))
+            return prepare(await inflight.do(cache_key, None))
+
+    breaker = circuit_breakers.get(o.netloc)
+
+    def short_circuit():
+        print("Circuit open {}".format(url))
+        return RequestResult(
+            exception="Skipped, host {} is unreachable ({} connection failures, last: {}) for: {}".format(
+                o.netloc, breaker.failures, breaker.last_failure, url
+            )
+        )
+
+    if breaker.is_open():
+        return short_circuit()
+
+    async def request():
+        # While the probe of a half open circuit is pending, waiting requests must not hold the slots of the host
+        if not await breaker.allow():
+            return short_circuit()
+        trace = request_tracer.new_record(url, o.netloc, method)
+        try:
+            async with host_limiters.get(o), inflight_requests:
+                result, body = await request_url(
+                    url,
+                    http_cache_key,
+                    session,
+                    with_text,
+                    headers,
+                    method,
+                    kind,
+                    trace,
+                    breaker,
+                    max_bytes=PROBE_RANGE_BYTES if probe else None,
                 )
+        finally:
+            # The probe of a half open circuit must settle, whatever the outcome of the request
+            breaker.release_probe()
+        request_tracer.finish(trace, result.status, result.exception)
+        response_cache[cache_keys[0]] = result
+        if body is not None:
+            body_cache.put(result.digest, body)
+            result = result._replace(text=body)
+        return result
+
+    return prepare(await inflight.do(cache_keys[0], request))
+
+
+async def get_parsed_url(
+    url: str,
+    session: ClientSession,
+    parser,
+    headers=None,
+    kind="capabilities",
+    reuse=None,
+    name=None,
+    incomplete=None,
+):
+    """Request url and parse its raw body with parser
+
+    Parsed results are cached in parsed_cache by the digest of the body and the name of parser and persisted
+    in parsed_store, such that unchanged documents are not parsed again in the next run. Exceptions raised by
+    parser are cached as well and raised again as RuntimeError. name replaces the name of parser in the cache
+    key, e.g. for a functools.partial. parser is run in cpu_executor, thus it must be picklable.
+
+    If reuse is given, a cached result is only used if reuse(parsed) is true. Otherwise the body is parsed again
+    with parser(body, reparse=True) and the cached result is replaced. Concurrent calls share one such parse of a
+    body, see reparses. Once the parsed result is stored, the body
+    is evicted from body_cache, unless incomplete(parsed) is true. Then it may have to be parsed again and is kept
+    as long as the LRU body_cache permits.
+
+    Returns
+    -------
+    RequestResult:
+        Result without text
+    object:
+        Result of parser, None if the request failed
+    """
+
+    if name is None:
+        name = parser.__name__
+
+    def keep_body(entry):
+        parsed, exception = entry
+        return exception is None and incomplete is not None and incomplete(parsed)
+
+    async def cached(result):
+        parsed_key = (result.digest, name)
+        entry = parsed_cache.get(parsed_key)
+        if entry is None:
+            entry = await parsed_store.get(*parsed_key)
+            if entry is None:
+                return None
+            parsed_cache[parsed_key] = entry
+        parsed, exception = entry
+        if exception is None and reuse is not None and not reuse(parsed):
+            return None
+        return entry
+
+    result = response_cache.get(
+        get_cache_key(canonical_url(url), "text", kind, headers)
+    )
+    entry = None if result is None else await cached(result)
+    if entry is None:
+        result = await get_url(
+            url, session, with_text=True, headers=headers, kind=kind, decode=False
+        )
+        if result.exception is not None:
+            return result, None
+        entry = await cached(result)
+        if entry is not None and not keep_body(entry):
+            body_cache.evict(result.digest)
+
+    if entry is None:
+        parsed_key = (result.digest, name)
+        previous = parsed_cache.get(parsed_key)
+        body = result.text
+
+        async def parse(reparse):
+            try:
+                if reparse:
+                    entry = (await cpu_executor.run(parser, body, reparse=True), None)
+                else:
+                    entry = (await cpu_executor.run(parser, body), None)
             except Exception as e:
-                print("Error for: {} ({})".format(url, str(e)))
-                response_cache[url] = RequestResult(
-                    exception="Exception {} for: {}".format(str(e), url)
-                )
+                entry = (None, str(e))
+            parsed_cache[parsed_key] = entry
+            await parsed_store.put(*parsed_key, entry)
+            if not keep_body(entry):
+                body_cache.evict(result.digest)
+            return entry
+
+        if previous is None:
+            entry = await parse(False)
         else:
-            print("Cached {}".format(url))
+            # Concurrent callers share one parse of the whole document
+            entry = await reparses.do(parsed_key, lambda: parse(True))
 
-        return response_cache[url]
+    parsed, exception = entry
+    if exception is not None:
+        raise RuntimeError(exception)
+    return result._replace(text=None), parsed
 
 
 async def test_url(url: str, session: ClientSession, headers: dict = None):
     """
     Test if a url is reachable
 
+    A HEAD request is sent first. If the server answers it with an HTTP status other than 200, e.g. because it
+    does not support HEAD requests, a GET request limited to the first PROBE_RANGE_BYTES bytes is sent. If the
+    HEAD request failed without response, e.g. due to a timeout, no GET request is sent. The body is never read.
+
     Parameters
     ----------
     url:  str
@@ -129,12 +717,17 @@ async def test_url(url: str, session: ClientSession, headers: dict = None):
     dict:
         Result dict created by create_result()
     """
-    resp = await get_url(url, session, headers=headers)
+    resp = await get_url(url, session, headers=headers, method="HEAD")
+    if resp.exception is None and resp.status not in {200, 206}:
+        range_headers = dict(headers or {})
+        range_headers["Range"] = "bytes=0-{}".format(PROBE_RANGE_BYTES - 1)
+        resp = await get_url(url, session, headers=range_headers)
+
     if resp.exception is not None:
         return create_result(ResultStatus.ERROR, resp.exception)
     else:
-        status_code = resp[0]
-        if status_code == 200:
+        status_code = resp.status
+        if status_code in {200, 206}:
             status = ResultStatus.GOOD
         else:
             status = ResultStatus.ERROR
@@ -142,112 +735,472 @@ async def test_url(url: str, session: ClientSession, headers: dict = None):
         return create_result(status, message)
 
 
-def parse_wms(xml):
+async def test_tile_url(
+    url: str, session: ClientSession, headers: dict = None, placeholders=True
+):
+    """
+    Test if a url serves a tile
+
+    Only the first PROBE_RANGE_BYTES bytes of the tile are requested. The tile is good if the response has
+    HTTP Code 200 or 206, validate_tile() accepts its first bytes and Content-Type and, if placeholders is set,
+    tile_fingerprints does not know it as placeholder tile of the host from a previous run. Tiles whose size is
+    unknown are not checked against placeholder tiles.
+
+    Parameters
+    ----------
+    url:  str
+        Url to test
+    session: ClientSession
+        aiohttp ClientSession object
+    headers: dict
+        custom http headers
+    placeholders: bool
+        Whether to check the tile against the placeholder tiles of the host
+
+    Returns
+    -------
+    dict:
+        Result dict created by create_result()
+    """
+    resp = await get_url(url, session, headers=headers, probe=True)
+    if resp.exception is not None:
+        return create_result(ResultStatus.ERROR, resp.exception)
+    if resp.status not in {200, 206}:
+        message = "HTTP Code {} for {}".format(resp.status, url)
+        return create_result(ResultStatus.ERROR, message)
+    reason = validate_tile(resp.text, resp.content_type)
+    if reason is not None:
+        return create_result(ResultStatus.ERROR, "{} for {}".format(reason, url))
+    # Without the size of the whole tile, the first bytes of different tiles can be identical, e.g. JPEG metadata
+    if placeholders and resp.size is not None:
+        fingerprint = "{}:{}".format(resp.digest, resp.size)
+        host = urlparse(url).netloc
+        if tile_fingerprints.add(host, fingerprint, canonical_url(url)):
+            message = "Placeholder tile, same content as other tiles of the host for {}"
+            return create_result(ResultStatus.ERROR, message.format(url))
+    return create_result(
+        ResultStatus.GOOD, "HTTP Code {} for {}".format(resp.status, url)
+    )
+
+
+def local_name(tag):
+    """Tag name without namespace"""
+    return tag[tag.rfind("}") + 1 :]
+
+
+def parse_wms(xml, layer_names=None, chunk_size=64 * 1024, reparse=False):
     """Rudimentary parsing of WMS Layers from GetCapabilites Request
     owslib.wms seems to have problems parsing some weird not relevant metadata.
     This function aims at only parsing relevant layer metadata
+
+    The document is parsed incrementally from the raw bytes, such that the encoding of the XML declaration is
+    respected. Namespaces are ignored by comparing local tag names. Layer elements are discarded once parsed.
+
+    Parameters
+    ----------
+    xml : bytes or str
+        GetCapabilities document
+    layer_names : iterable of str
+        If given, parsing stops as soon as all these layers are parsed and the result is marked as not complete.
+    chunk_size : int
+        Number of bytes fed to the parser at once
+    reparse : bool
+        The document was parsed before for other layers. It is parsed completely, regardless of layer_names.
+
+    Returns
+    -------
+    dict:
+        version, layers as WmsLayers, formats, Fees, AccessConstraints and whether the whole document was parsed
+        (complete)
     """
-    wms = {}
-    # Remove prefixes to make parsing easier
-    # From https://stackoverflow.com/questions/13412496/python-elementtree-module-how-to-ignore-the-namespace-of-xml-files-to-locate-ma
+    wanted = None if layer_names is None or reparse else set(layer_names)
+
+    def parse_bbox(element, tag):
+        if tag == "EX_GeographicBoundingBox":
+            # WMS Version 1.3.0
+            values = {local_name(child.tag): child.text for child in element}
+            keys = [
+                "westBoundLongitude",
+                "southBoundLatitude",
+                "eastBoundLongitude",
+                "northBoundLatitude",
+            ]
+        else:
+            # WMS Version < 1.3.0
+            values = element.attrib
+            keys = ["minx", "miny", "maxx", "maxy"]
+        return [float(values[key].replace(",", ".")) for key in keys]
+
+    def parse(data):
+        layers = WmsLayers()
+        wms = {"layers": layers, "formats": [], "Fees": [], "AccessConstraints": []}
+        crs_sets = CrsSets()
+        # Local names of the open elements and the open layers
+        path = []
+        layer_stack = []
+        # CRS and styles of the open layers not yet merged into the layers
+        pending = []
+
+        def merge_pending():
+            """Merge the CRS and styles parsed so far into the innermost open layer"""
+            layer = layer_stack[-1]
+            own_crs, own_styles = pending[-1]
+            if len(own_crs) > 0:
+                layer.crs = crs_sets.get(layer.crs.union(own_crs))
+                own_crs.clear()
+            if len(own_styles) > 0:
+                layer.styles = {**layer.styles, **own_styles}
+                own_styles.clear()
+
+        def handle_start(element):
+            tag = local_name(element.tag)
+            if len(path) == 0:
+                if tag in {"ServiceExceptionReport", "ServiceException"}:
+                    raise RuntimeError("WMS service exception")
+                if tag not in {"WMT_MS_Capabilities", "WMS_Capabilities"}:
+                    raise RuntimeError(
+                        "No Capabilities Element present: Root tag: {}".format(tag)
+                    )
+                if "version" not in element.attrib:
+                    raise RuntimeError("WMS version cannot be identified.")
+                wms["version"] = element.attrib["version"]
+            elif tag == "Layer" and (
+                path[-1] == "Capability"
+                or (path[-1] == "Layer" and len(layer_stack) > 0)
+            ):
+                # CRS, Styles and BBOX are inherited from parent
+                if path[-1] == "Layer":
+                    merge_pending()
+                    parent = layer_stack[-1]
+                    layer = WmsLayer(parent.crs, parent.styles, parent.bbox)
+                else:
+                    layer = WmsLayer()
+                layer_stack.append(layer)
+                pending.append(([], {}))
+            path.append(tag)
+
+        def handle_end(element):
+            """Returns True once all wanted layers are parsed"""
+            tag = path.pop()
+            parent_tag = path[-1] if len(path) > 0 else None
+
+            if parent_tag == "Layer" and len(layer_stack) > 0 and not tag == "Layer":
+                layer = layer_stack[-1]
+                own_crs, own_styles = pending[-1]
+                if tag in {"Name", "Title", "Abstract"}:
+                    setattr(layer, tag.lower(), element.text)
+                elif tag in {"CRS", "SRS"} and element.text is not None:
+                    own_crs.append(sys.intern(element.text.upper()))
+                elif tag == "Style":
+                    style = {}
+                    for child in element:
+                        child_tag = local_name(child.tag)
+                        if child_tag in {"Title", "Name"}:
+                            style[child_tag] = child.text
+                    if "Name" in style:
+                        own_styles[style["Name"]] = style
+                elif tag in {"EX_GeographicBoundingBox", "LatLonBoundingBox"}:
+                    layer.bbox = parse_bbox(element, tag)
+            elif tag == "Layer" and parent_tag in {"Capability", "Layer"}:
+                merge_pending()
+                layer = layer_stack.pop()
+                pending.pop()
+                element.clear()
+                if layer.name is not None:
+                    layers.add(layer)
+                    if wanted is not None and all(name in layers for name in wanted):
+                        return True
+            elif tag == "Format" and path[-3:] == ["Capability", "Request", "GetMap"]:
+                wms["formats"].append(element.text)
+            elif tag in {"Fees", "AccessConstraints"}:
+                wms[tag].append(element.text)
+            return False
+
+        parser = ET.XMLPullParser(events=("start", "end"))
+        wms["complete"] = True
+        for start in [*range(0, len(data), chunk_size), None]:
+            if start is None:
+                parser.close()
+            else:
+                parser.feed(data[start : start + chunk_size])
+            for event, element in parser.read_events():
+                if event == "start":
+                    handle_start(element)
+                elif handle_end(element):
+                    wms["complete"] = False
+                    return wms
+        return wms
+
     try:
-        it = ET.iterparse(StringIO(xml))
-        for _, el in it:
-            _, _, el.tag = el.tag.rpartition("}")
-        root = it.root
-    except:
+        return parse(xml)
+    except ET.ParseError:
+        if isinstance(xml, bytes):
+            # Retry documents whose encoding does not match their XML declaration with a guessed encoding
+            match = charset_normalizer.from_bytes(xml).best()
+            if match is not None:
+                try:
+                    return parse(str(match))
+                except ET.ParseError:
+                    pass
         raise RuntimeError("Could not parse XML.")
 
-    root_tag = root.tag.rpartition("}")[-1]
-    if root_tag in {"ServiceExceptionReport", "ServiceException"}:
-        raise RuntimeError("WMS service exception")
 
-    if root_tag not in {"WMT_MS_Capabilities", "WMS_Capabilities"}:
-        raise RuntimeError(
-            "No Capabilities Element present: Root tag: {}".format(root_tag)
+def parse_wmts(xml):
+    """Parse the text of a WMTS GetCapabilities response with owslib
+
+    Only a compact summary is returned, the owslib object is discarded.
+    """
+    if isinstance(xml, str):
+        xml = xml.encode("utf-8")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        wmts = WebMapTileService(None, xml=xml)
+    return {
+        "layers": list(wmts.contents),
+        "tile_matrix_sets": list(wmts.tilematrixsets),
+    }
+
+
+def get_getcapabilities_url(
+    url_parts, wms_args, wms_version=None, parameter_uppercase=False
+):
+    """Build WMS GetCapabilities url from the parts of a WMS url
+
+    The url is canonical: Host is lower cased, GetMap parameters are stripped and the remaining extra parameters
+    are sorted, such that WMS urls that only differ in parameter order or GetMap parameters result in the same
+    GetCapabilities url.
+
+    Parameters
+    ----------
+    url_parts : list
+        Url split by urlparse()
+    wms_args : dict
+        Query parameters of the url with lower case keys
+    wms_version : str
+        WMS version to request, None to let the server choose
+    parameter_uppercase : bool
+        Whether parameter keys are sent in upper case
+    """
+    get_capabilities_args = {"service": "WMS", "request": "GetCapabilities"}
+    if wms_version is not None:
+        get_capabilities_args["version"] = wms_version
+
+    # Keep extra arguments, such as map or key
+    for key in sorted(wms_args):
+        if key not in WMS_GETMAP_PARAMETERS and key not in get_capabilities_args:
+            get_capabilities_args[key] = wms_args[key]
+
+    parameters = get_capabilities_args.items()
+    if parameter_uppercase:
+        parameters = [(k.upper(), v) for k, v in parameters]
+    else:
+        parameters = [(k.lower(), v) for k, v in parameters]
+    url_parts = list(url_parts)
+    url_parts[1] = url_parts[1].lower()
+    url_parts[4] = urlencode(parameters)
+    url_parts[5] = ""
+    return urlunparse(url_parts)
+
+
+def get_wms_endpoint_key(url_parts, wms_args):
+    """Key identifying a WMS endpoint: Url without GetMap and GetCapabilities specific parameters"""
+    extra_args = sorted(
+        (key, value)
+        for key, value in wms_args.items()
+        if key not in WMS_GETMAP_PARAMETERS and key not in {"service"}
+    )
+    parts = list(url_parts)
+    parts[1] = parts[1].lower()
+    parts[4] = urlencode(extra_args)
+    parts[5] = ""
+    return urlunparse(parts)
+
+
+async def get_wms_capabilities(
+    url_parts,
+    wms_args,
+    session: ClientSession,
+    headers=None,
+    stop_on_exception=False,
+    layer_names=None,
+):
+    """Negotiate and parse the GetCapabilities document of a WMS endpoint
+
+    The variants of the request (parameter case and WMS version) are tried one after another until a response
+    can be parsed. The variant that worked is remembered per endpoint in wms_variants and tried first next time.
+
+    A successful negotiation is done once per endpoint, headers and run, all sources using the same endpoint
+    with the same headers share its outcome in wms_endpoints and the parsed document. Failed negotiations are
+    not kept, such that e.g. requests refused by an open circuit breaker are tried again by the next source.
+
+    Parameters
+    ----------
+    url_parts : list
+        Url split by urlparse()
+    wms_args : dict
+        Query parameters of the url with lower case keys
+    session : ClientSession
+        aiohttp ClientSession object
+    headers : dict
+        custom http headers
+    stop_on_exception : bool
+        Stop if a request fails, e.g. due to a timeout, instead of trying the next variant
+    layer_names : list of str
+        Layers of interest. If given, parsing may stop once these layers are found.
+
+    Returns
+    -------
+    dict:
+        The result of parse_wms(), None if no variant worked
+    list:
+        Messages of the variants that failed
+    """
+    endpoint = get_wms_endpoint_key(url_parts, wms_args)
+    endpoint_key = (endpoint, tuple(sorted((headers or {}).items())))
+
+    parse_wms_layers = functools.partial(parse_wms, layer_names=layer_names)
+
+    def reuse(wms):
+        return wms["complete"] or (
+            layer_names is not None
+            and all(name in wms["layers"] for name in layer_names)
         )
 
-    if "version" not in root.attrib:
-        raise RuntimeError("WMS version cannot be identified.")
-    version = root.attrib["version"]
-    wms["version"] = version
-
-    layers = {}
-
-    def parse_layer(element, crs=set(), styles={}, bbox=None):
-        new_layer = {"CRS": crs, "Styles": {}, "BBOX": bbox}
-        new_layer["Styles"].update(styles)
-        for tag in ["Name", "Title", "Abstract"]:
-            e = element.find("./{}".format(tag))
-            if e is not None:
-                new_layer[e.tag] = e.text
-        for tag in ["CRS", "SRS"]:
-            es = element.findall("./{}".format(tag))
-            for e in es:
-                new_layer["CRS"].add(e.text.upper())
-        for tag in ["Style"]:
-            es = element.findall("./{}".format(tag))
-            for e in es:
-                new_style = {}
-                for styletag in ["Title", "Name"]:
-                    el = e.find("./{}".format(styletag))
-                    if el is not None:
-                        new_style[styletag] = el.text
-                new_layer["Styles"][new_style["Name"]] = new_style
-        # WMS Version 1.3.0
-        e = element.find("./EX_GeographicBoundingBox")
-        if e is not None:
-            bbox = [
-                float(e.find("./{}".format(orient)).text.replace(",", "."))
-                for orient in [
-                    "westBoundLongitude",
-                    "southBoundLatitude",
-                    "eastBoundLongitude",
-                    "northBoundLatitude",
-                ]
-            ]
-            new_layer["BBOX"] = bbox
-        # WMS Version < 1.3.0
-        e = element.find("./LatLonBoundingBox")
-        if e is not None:
-            bbox = [
-                float(e.attrib[orient].replace(",", "."))
-                for orient in ["minx", "miny", "maxx", "maxy"]
-            ]
-            new_layer["BBOX"] = bbox
+    def incomplete(wms):
+        return not wms["complete"]
+
+    async def negotiate():
+        exceptions = []
+        for parameter_uppercase, wmsversion in wms_variants.order(
+            endpoint, wms_capabilities_variants()
+        ):
+            if wmsversion is None:
+                wmsversion_str = "-"
+            else:
+                wmsversion_str = wmsversion
+
+            wms_getcapabilites_url = None
+            try:
+                wms_getcapabilites_url = get_getcapabilities_url(
+                    url_parts, wms_args, wmsversion, parameter_uppercase
+                )
+                resp, wms = await get_parsed_url(
+                    wms_getcapabilites_url,
+                    session,
+                    parse_wms_layers,
+                    headers=headers,
+                    reuse=reuse,
+                    name="parse_wms",
+                    incomplete=incomplete,
+                )
+                if resp.exception is not None:
+                    exceptions.append(
+                        "WMS {}: {}".format(wmsversion_str, resp.exception)
+                    )
+                    if stop_on_exception:
+                        break
+                    continue
+                wms_variants.put(endpoint, (parameter_uppercase, wmsversion))
+                return WmsEndpoint(wms_getcapabilites_url, wmsversion_str, exceptions)
+            except Exception as e:
+                exceptions.append(
+                    "WMS {}: URL: {} Error: {}".format(
+                        wmsversion_str, wms_getcapabilites_url, str(e)
+                    )
+                )
+        return WmsEndpoint(None, None, exceptions)
 
-        if "Name" in new_layer:
-            layers[new_layer["Name"]] = new_layer
+    negotiated = wms_endpoints.get(endpoint_key)
+    if negotiated is None:
+        negotiated = await wms_negotiations.do(
+            (endpoint_key, stop_on_exception), negotiate
+        )
+        if negotiated.url is not None:
+            wms_endpoints[endpoint_key] = negotiated
+
+    exceptions = list(negotiated.exceptions)
+    if negotiated.url is None:
+        return None, exceptions
 
-        for sl in element.findall("./Layer"):
-            parse_layer(
-                sl, new_layer["CRS"].copy(), new_layer["Styles"], new_layer["BBOX"]
+    # Parse the document again if the negotiation did not parse the layers of interest
+    try:
+        resp, wms = await get_parsed_url(
+            negotiated.url,
+            session,
+            parse_wms_layers,
+            headers=headers,
+            reuse=reuse,
+            name="parse_wms",
+            incomplete=incomplete,
+        )
+        if resp.exception is not None:
+            exceptions.append("WMS {}: {}".format(negotiated.version, resp.exception))
+            return None, exceptions
+    except Exception as e:
+        exceptions.append(
+            "WMS {}: URL: {} Error: {}".format(
+                negotiated.version, negotiated.url, str(e)
             )
+        )
+        return None, exceptions
+    return wms, exceptions
 
-    # Find child layers. CRS and Styles are inherited from parent
-    top_layers = root.findall(".//Capability/Layer")
-    for top_layer in top_layers:
-        parse_layer(top_layer)
 
-    wms["layers"] = layers
+def get_area_outside_bboxes(geometry, bboxes):
+    """Percentage of the area of a GeoJSON geometry outside of each bounding box
 
-    # Parse formats
-    formats = []
-    for es in root.findall(".//Capability/Request/GetMap/Format"):
-        formats.append(es.text)
-    wms["formats"] = formats
+    Bounding boxes containing the bounds of the geometry or not intersecting it at all are decided without
+    computing the difference. For the remaining bounding boxes the differences are computed at once on a simplified
+    geometry if it has more than BBOX_SIMPLIFY_VERTICES vertices.
 
-    # Parse access constraints and fees
-    constraints = []
-    for es in root.findall(".//AccessConstraints"):
-        constraints.append(es.text)
-    fees = []
-    for es in root.findall(".//Fees"):
-        fees.append(es.text)
-    wms["Fees"] = fees
-    wms["AccessConstraints"] = constraints
+    Parameters
+    ----------
+    geometry : dict
+        GeoJSON geometry
+    bboxes : list
+        Bounding boxes as [minx, miny, maxx, maxy]
 
-    return wms
+    Returns
+    -------
+    list of float:
+        Percentage of the area outside of each bounding box, empty if the geometry is not valid
+    """
+    geom = shape(geometry)
+    if not geom.is_valid:
+        return []
+    minx, miny, maxx, maxy = geom.bounds
+    outside = [None] * len(bboxes)
+    remaining = []
+    for i, bbox in enumerate(bboxes):
+        if bbox[0] <= minx and bbox[1] <= miny and bbox[2] >= maxx and bbox[3] >= maxy:
+            outside[i] = 0.0
+        elif bbox[0] > maxx or bbox[1] > maxy or bbox[2] < minx or bbox[3] < miny:
+            outside[i] = 100.0
+        else:
+            remaining.append(i)
+    if len(remaining) == 0:
+        return outside
+
+    geom_bboxes = shapely.box(*np.array([bboxes[i] for i in remaining]).T)
+    shapely.prepare(geom)
+    intersects = shapely.intersects(geom, geom_bboxes)
+    for i, intersect in zip(remaining, intersects):
+        if not intersect:
+            outside[i] = 100.0
+    remaining = [i for i, intersect in zip(remaining, intersects) if intersect]
+    geom_bboxes = geom_bboxes[intersects]
+    if len(remaining) == 0:
+        return outside
+
+    if shapely.get_num_coordinates(geom) > BBOX_SIMPLIFY_VERTICES:
+        tolerance = max(maxx - minx, maxy - miny) * BBOX_SIMPLIFY_TOLERANCE
+        simplified = geom.simplify(tolerance, preserve_topology=True)
+        if simplified.is_valid and simplified.area > 0.0:
+            geom = simplified
+    areas = shapely.area(shapely.difference(geom, geom_bboxes))
+    for i, area in zip(remaining, areas):
+        outside[i] = float(area / geom.area * 100.0)
+    return outside
 
 
 async def check_tms(source, session: ClientSession):
@@ -280,40 +1233,36 @@ async def check_tms(source, session: ClientSession):
 
     try:
         if "geometry" in source and source["geometry"] is not None:
-            geom = shape(source["geometry"])
-            centroid = geom.representative_point()
+            points = await cpu_executor.run(
+                sample_points, source["geometry"], TMS_SAMPLE_POINTS
+            )
         else:
-            centroid = Point(0, 0)
+            points = [(0.0, 0.0)]
+        lons, lats = np.array(points).T
+        locations_str = " ".join("{},{}".format(x, y) for x, y in points)
 
         tms_url = source["properties"]["url"]
+        template = TileUrlTemplate(tms_url)
 
-        def validate_url():
-            url = (
-                re.sub(r"switch:?([^}]*)", "switch", tms_url)
-                .replace("{", "")
-                .replace("}", "")
-            )
-            return validators.url(url)
-
-        if not validate_url():
+        if not validators.url(template.validation_url()):
             error_msgs.append("URL validation error: {}".format(tms_url))
 
-        parameters = {}
-
         # {z} instead of {zoom}
-        if "{z}" in source["properties"]["url"]:
+        if "z" in template.placeholders:
             error_msgs.append("{z} found instead of {zoom} in tile url")
-            return
+            return info_msgs, warning_msgs, error_msgs
 
-        if "{apikey}" in tms_url:
+        if "apikey" in template.placeholders:
             warning_msgs.append("Not possible to check URL, apikey is required.")
             return info_msgs, warning_msgs, error_msgs
 
-        if "{switch:" in tms_url:
-            match = re.search(r"switch:?([^}]*)", tms_url)
-            switches = match.group(1).split(",")
-            tms_url = tms_url.replace(match.group(0), "switch")
-            parameters["switch"] = switches[0]
+        if len(template.unsupported) > 0:
+            error_msgs.append(
+                "Unsupported placeholders in tile url: {}".format(
+                    ",".join(sorted(template.unsupported))
+                )
+            )
+            return info_msgs, warning_msgs, error_msgs
 
         min_zoom = 0
         max_zoom = 22
@@ -322,52 +1271,65 @@ async def check_tms(source, session: ClientSession):
         if "max_zoom" in source["properties"]:
             max_zoom = int(source["properties"]["max_zoom"])
 
-        zoom_failures = []
-        zoom_success = []
-        tested_zooms = set()
+        # Number of reachable and tested tiles per zoom
+        sampled_tiles = {}
+        # Messages of failed tile tests
+        tile_failures = []
 
-        async def test_zoom(zoom):
-            tested_zooms.add(zoom)
-            tile = mercantile.tile(centroid.x, centroid.y, zoom)
-
-            query_url = tms_url
-            if "{-y}" in tms_url:
-                y = 2**zoom - 1 - tile.y
-                query_url = query_url.replace("{-y}", str(y))
-            elif "{!y}" in tms_url:
-                y = 2 ** (zoom - 1) - 1 - tile.y
-                query_url = query_url.replace("{!y}", str(y))
-            else:
-                query_url = query_url.replace("{y}", str(tile.y))
-            parameters["x"] = tile.x
-            parameters["zoom"] = zoom
-            query_url = query_url.format(**parameters)
-            await asyncio.sleep(0.5)
-            tms_url_status = await test_url(query_url, session, headers)
+        async def test_tile(zoom, x, y, switch=None):
+            query_url = template.render(zoom, x, y, switch)
+            tms_url_status = await test_tile_url(query_url, session, headers)
             if tms_url_status["status"] == ResultStatus.GOOD:
-                zoom_success.append(zoom)
                 return True
-            else:
-                zoom_failures.append(zoom)
-                return False
-
-        # Test min zoom. In case of failure, increase test range
-        result = await test_zoom(min_zoom)
-        if not result:
-            for zoom in range(min_zoom + 1, min(min_zoom + 4, max_zoom)):
-                if zoom not in tested_zooms:
-                    result = await test_zoom(zoom)
-                    if result:
-                        break
+            tile_failures.append(tms_url_status["message"])
+            return False
 
-        # Test max_zoom. In case of failure, increase test range
-        result = await test_zoom(max_zoom)
-        if not result:
-            for zoom in range(max_zoom, max(max_zoom - 4, min_zoom), -1):
-                if zoom not in tested_zooms:
-                    result = await test_zoom(zoom)
-                    if result:
-                        break
+        async def test_zoom(zoom):
+            """Test the tiles of all sampled points, a zoom is reachable if any tile is"""
+            xs, ys = tile_coordinates(lons, lats, zoom)
+            tiles = sorted(set(zip(xs.tolist(), ys.tolist())))
+            results = await asyncio.gather(*[test_tile(zoom, x, y) for x, y in tiles])
+            sampled_tiles[zoom] = (sum(results), len(tiles))
+            return any(results)
+
+        # Test min zoom and max zoom. In case of failure, increase test range. Both sides are tested at the same
+        # time, fallback zooms are probed speculatively within the concurrency limit of the host.
+        min_zooms = [min_zoom] + list(range(min_zoom + 1, min(min_zoom + 4, max_zoom)))
+        max_zooms = [max_zoom] + list(
+            range(max_zoom - 1, max(max_zoom - 4, min_zoom), -1)
+        )
+        tms_host = urlparse(template.render(min_zoom, 0, 0))
+        window = host_limiters.get(tms_host).limit.concurrency
+        # Every alternative of {switch:...} is tested at min zoom at the same time at the first sampled point.
+        # The request of the first alternative is shared with the zoom tests.
+        mirrors = template.switches
+        xs, ys = tile_coordinates(lons[:1], lats[:1], min_zoom)
+        probed, *mirror_results = await asyncio.gather(
+            asyncio.gather(
+                probe_in_order(min_zooms, test_zoom, window),
+                probe_in_order(max_zooms, test_zoom, window),
+            ),
+            *[test_tile(min_zoom, xs[0], ys[0], mirror) for mirror in mirrors],
+        )
+        zoom_success = {zoom for side in probed for zoom, ok in side if ok}
+        zoom_failures = {zoom for side in probed for zoom, ok in side if not ok}
+
+        # If max zoom is not reachable, search the highest reachable zoom by bisection between the highest
+        # reachable zoom found so far and max zoom. Assumes that tiles of all zooms below a reachable zoom exist.
+        suggested_max_zoom = None
+        if max_zoom in zoom_failures and len(zoom_success) > 0:
+            low = max(zoom for zoom in zoom_success if zoom < max_zoom)
+            high = min(zoom for zoom in zoom_failures if zoom > low)
+            while high - low > 1:
+                zoom = (low + high) // 2
+                if await test_zoom(zoom):
+                    zoom_success.add(zoom)
+                    low = zoom
+                else:
+                    zoom_failures.add(zoom)
+                    high = zoom
+            suggested_max_zoom = low
+        tested_zooms = zoom_success | zoom_failures
 
         tested_str = ",".join(list(map(str, sorted(tested_zooms))))
         if len(zoom_failures) == 0 and len(zoom_success) > 0:
@@ -378,15 +1340,54 @@ async def check_tms(source, session: ClientSession):
             not_found_str = ",".join(list(map(str, sorted(zoom_failures))))
             warning_msgs.append(
                 "Zoom level {} not reachable. (Tested: {}) "
-                "Tiles might not be present at tested location: {},{}".format(
-                    not_found_str, tested_str, centroid.x, centroid.y
+                "Tiles might not be present at tested locations: {}".format(
+                    not_found_str, tested_str, locations_str
                 )
             )
         else:
             error_msgs.append(
                 "No zoom level reachable. (Tested: {}) "
-                "Tiles might not be present at tested location: {},{}".format(
-                    tested_str, centroid.x, centroid.y
+                "Tiles might not be present at tested locations: {}".format(
+                    tested_str, locations_str
+                )
+            )
+
+        if len(tile_failures) > 0:
+            info_msgs.append("Example of a failed tile: {}".format(tile_failures[0]))
+
+        partially_reachable = [
+            "{}: {}/{}".format(zoom, *sampled_tiles[zoom])
+            for zoom in sorted(zoom_success)
+            if sampled_tiles[zoom][0] < sampled_tiles[zoom][1]
+        ]
+        if len(partially_reachable) > 0:
+            info_msgs.append(
+                "Reachable of sampled tiles per zoom level: {}".format(
+                    ", ".join(partially_reachable)
+                )
+            )
+
+        failed_mirrors = [
+            mirror for mirror, ok in zip(mirrors, mirror_results) if not ok
+        ]
+        working_mirrors = [mirror for mirror, ok in zip(mirrors, mirror_results) if ok]
+        if len(failed_mirrors) > 0 and len(working_mirrors) > 0:
+            warning_msgs.append(
+                "Switch alternatives not reachable: {}, reachable: {}. (Tested zoom level: {})".format(
+                    ",".join(failed_mirrors), ",".join(working_mirrors), min_zoom
+                )
+            )
+        elif len(failed_mirrors) > 1:
+            warning_msgs.append(
+                "None of the switch alternatives {} reachable. (Tested zoom level: {})".format(
+                    ",".join(failed_mirrors), min_zoom
+                )
+            )
+
+        if suggested_max_zoom is not None and not suggested_max_zoom == max_zoom:
+            warning_msgs.append(
+                "Suggested max_zoom: {}, the highest zoom level reachable at tested locations.".format(
+                    suggested_max_zoom
                 )
             )
 
@@ -396,6 +1397,78 @@ async def check_tms(source, session: ClientSession):
     return info_msgs, warning_msgs, error_msgs
 
 
+async def check_wms_getmap(source, wms_args, session: ClientSession, headers=None):
+    """Request a small image with the url of a WMS source at its representative point
+
+    The image has the resolution of tiles at WMS_GETMAP_ZOOM, limited to the zoom range of the source. It is
+    checked by test_tile_url(), i.e. by its first bytes and Content-Type. Images of different layers can be
+    identical, thus they are not checked against placeholder tiles. The url of the source must not contain
+    unsupported placeholders, see TileUrlTemplate.
+
+    Parameters
+    ----------
+    source : dict
+        Source dictionary
+    wms_args : dict
+        Query parameters of the url with lower case keys
+    session : ClientSession
+        aiohttp ClientSession object
+    headers : dict
+        custom http headers
+
+    Returns
+    -------
+    str or None:
+        Error message, None if the server returned an image
+    list:
+        Info messages
+    """
+    available_projections = source["properties"].get("available_projections", [])
+    projections = [proj for proj in GETMAP_PROJECTIONS if proj in available_projections]
+    if len(projections) == 0:
+        return None, [
+            "GetMap request not tested, none of {} is available.".format(
+                ",".join(GETMAP_PROJECTIONS)
+            )
+        ]
+    proj = projections[0]
+
+    template = TileUrlTemplate(source["properties"]["url"])
+
+    if source["geometry"] is not None:
+        points = await cpu_executor.run(sample_points, source["geometry"], 1)
+        lon, lat = points[0]
+    else:
+        lon, lat = 0.0, 0.0
+
+    zoom = WMS_GETMAP_ZOOM
+    if "max_zoom" in source["properties"]:
+        zoom = min(zoom, int(source["properties"]["max_zoom"]))
+    if "min_zoom" in source["properties"]:
+        zoom = max(zoom, int(source["properties"]["min_zoom"]))
+
+    # WMS 1.3.0 uses the axis order of the CRS, which is latitude, longitude for EPSG:4326
+    version = tuple(
+        int(part) for part in wms_args["version"].split(".") if part.isdigit()
+    )
+    lat_lon_order = proj == "EPSG:4326" and version >= (1, 3, 0)
+
+    url = template.render_values(
+        {
+            "proj": proj,
+            "bbox": render_getmap_bbox(
+                lon, lat, zoom, WMS_GETMAP_SIZE, proj, lat_lon_order
+            ),
+            "width": str(WMS_GETMAP_SIZE),
+            "height": str(WMS_GETMAP_SIZE),
+        }
+    )
+    result = await test_tile_url(url, session, headers, placeholders=False)
+    if result["status"] == ResultStatus.GOOD:
+        return None, []
+    return "GetMap request failed: {}".format(result["message"]), []
+
+
 async def check_wms(source, session: ClientSession):
     """
     Check WMS source
@@ -514,89 +1587,10 @@ async def check_wms(source, session: ClientSession):
             "Parameter 'styles' is missing in url. 'STYLES=' can be used to request default style."
         )
 
-    def get_getcapabilitie_url(wms_version=None, parameter_uppercase=False):
-
-        get_capabilities_args = {"service": "WMS", "request": "GetCapabilities"}
-        if wms_version is not None:
-            get_capabilities_args["version"] = wms_version
-
-        # Keep extra arguments, such as map or key
-        for key in wms_args:
-            if key not in {
-                "version",
-                "request",
-                "layers",
-                "bbox",
-                "width",
-                "height",
-                "format",
-                "crs",
-                "srs",
-                "styles",
-                "transparent",
-                "dpi",
-                "map_resolution",
-                "format_options",
-            }:
-                get_capabilities_args[key] = wms_args[key]
-
-        parameters = get_capabilities_args.items()
-        if parameter_uppercase:
-            parameters = [(k.upper(), v) for k, v in parameters]
-        else:
-            parameters = [(k.lower(), v) for k, v in parameters]
-        url_parts[4] = urlencode(parameters)
-        return urlunparse(url_parts)
-
-    # We first send a service=WMS&request=GetCapabilities request to server
-    # According to the WMS Specification Section 6.2 Version numbering and negotiation, the server should return
-    # the GetCapabilities XML with the highest version the server supports.
-    # If this fails, it is tried to explicitly specify a WMS version
-    exceptions = []
-    wms = None
-    for parameter_uppercase in [True, False]:
-        for wmsversion in [None, "1.3.0", "1.1.1", "1.1.0", "1.0.0"]:
-            if wmsversion is None:
-                wmsversion_str = "-"
-            else:
-                wmsversion_str = wmsversion
-
-            wms_getcapabilites_url = None
-            try:
-                wms_getcapabilites_url = get_getcapabilitie_url(
-                    wmsversion, parameter_uppercase
-                )
-
-                resp = await get_url(
-                    wms_getcapabilites_url, session, with_text=True, headers=headers
-                )
-                if resp.exception is not None:
-                    exceptions.append("WMS {}: {}".format(wmsversion, resp.exception))
-                    continue
-                xml = resp.text
-                if isinstance(xml, bytes):
-                    # Parse xml encoding to decode
-                    try:
-                        xml_ignored = xml.decode(errors="ignore")
-                        str_encoding = re.search('encoding="(.*?)"', xml_ignored).group(
-                            1
-                        )
-                        xml = xml.decode(encoding=str_encoding)
-                    except Exception as e:
-                        raise RuntimeError(
-                            "Could not parse encoding: {}".format(str(e))
-                        )
-
-                wms = parse_wms(xml)
-                if wms is not None:
-                    break
-            except Exception as e:
-                exceptions.append(
-                    "WMS {}: URL: {} Error: {}".format(
-                        wmsversion_str, wms_getcapabilites_url, str(e)
-                    )
-                )
-                continue
+    layer_names = wms_args["layers"].split(",") if "layers" in wms_args else None
+    wms, exceptions = await get_wms_capabilities(
+        url_parts, wms_args, session, headers, layer_names=layer_names
+    )
 
     if wms is None:
         for msg in exceptions:
@@ -608,11 +1602,6 @@ async def check_wms(source, session: ClientSession):
     for fee in wms["Fees"]:
         info_msgs.append("WMS Fees: {}".format(fee))
 
-    if source["geometry"] is None:
-        geom = None
-    else:
-        geom = shape(source["geometry"])
-
     # Check layers
     if "layers" in wms_args:
         layer_arg = wms_args["layers"]
@@ -620,13 +1609,12 @@ async def check_wms(source, session: ClientSession):
         layers = layer_arg.split(",")
         for layer_name in layer_arg.split(","):
             if layer_name not in wms["layers"]:
-                for wms_layer in wms["layers"]:
-                    if layer_name.lower() == wms_layer.lower():
-                        warning_msgs.append(
-                            "Layer '{}' is advertised by WMS server as '{}'".format(
-                                layer_name, wms_layer
-                            )
+                for wms_layer in wms["layers"].find_case_insensitive(layer_name):
+                    warning_msgs.append(
+                        "Layer '{}' is advertised by WMS server as '{}'".format(
+                            layer_name, wms_layer
                         )
+                    )
                 not_found_layers.append(layer_name)
 
         if len(not_found_layers) > 0:
@@ -640,25 +1628,27 @@ async def check_wms(source, session: ClientSession):
         # Check source geometry against layer bounding box
         # Regardless of its projection, each layer should advertise an approximated bounding box in lon/lat.
         # See WMS 1.3.0 Specification Section 7.2.4.6.6 EX_GeographicBoundingBox
-        if geom is not None and geom.is_valid:
-            max_outside = 0.0
-            for layer_name in layers:
-                if layer_name in wms["layers"]:
-                    bbox = wms["layers"][layer_name]["BBOX"]
-                    geom_bbox = box(*bbox)
-                    geom_outside_bbox = geom.difference(geom_bbox)
-                    area_outside_bbox = geom_outside_bbox.area / geom.area * 100.0
-                    max_outside = max(max_outside, area_outside_bbox)
+        if source["geometry"] is not None:
+            bboxes = [
+                wms["layers"][layer_name].bbox
+                for layer_name in layers
+                if layer_name in wms["layers"]
+                and wms["layers"][layer_name].bbox is not None
+            ]
+            area_outside_bboxes = await cpu_executor.run(
+                get_area_outside_bboxes, source["geometry"], bboxes
+            )
+            max_outside = max(area_outside_bboxes, default=0.0)
 
             if max_outside > 100.0:
                 error_msgs.append(
                     "{}% of geometry is outside of the layers "
-                    "bounding box.".format(round(area_outside_bbox, 2))
+                    "bounding box.".format(round(max_outside, 2))
                 )
             elif max_outside > 15.0:
                 warning_msgs.append(
                     "{}% of geometry is outside of the layers "
-                    "bounding box.".format(round(area_outside_bbox, 2))
+                    "bounding box.".format(round(max_outside, 2))
                 )
 
         # Check styles
@@ -675,7 +1665,7 @@ async def check_wms(source, session: ClientSession):
                             len(style) > 0
                             and not style == "default"
                             and layer_name in wms["layers"]
-                            and style not in wms["layers"][layer_name]["Styles"]
+                            and style not in wms["layers"][layer_name].styles
                         ):
                             error_msgs.append(
                                 "Layer '{}' does not support style '{}'".format(
@@ -695,11 +1685,11 @@ async def check_wms(source, session: ClientSession):
                         # WMS sync bot checks if these projections are supported despite not advertised
                         if crs in {"EPSG:4326", "EPSG:3857"}:
                             continue
-                        if crs.upper() not in wms["layers"][layer_name]["CRS"]:
+                        if crs.upper() not in wms["layers"][layer_name].crs:
                             not_supported_crs.add(crs)
 
                     if len(not_supported_crs) > 0:
-                        supported_crs_str = ",".join(wms["layers"][layer_name]["CRS"])
+                        supported_crs_str = ",".join(wms["layers"][layer_name].crs)
                         not_supported_crs_str = ",".join(not_supported_crs)
                         warning_msgs.append(
                             "Layer '{}': CRS '{}' not in: {}".format(
@@ -711,7 +1701,7 @@ async def check_wms(source, session: ClientSession):
                     for crs in crs_should_included_if_available:
                         if (
                             crs not in source["properties"]["available_projections"]
-                            and crs in wms["layers"][layer_name]["CRS"]
+                            and crs in wms["layers"][layer_name].crs
                         ):
                             supported_but_not_included.add(crs)
 
@@ -733,6 +1723,25 @@ async def check_wms(source, session: ClientSession):
             )
         )
 
+    # Check that the server returns an image
+    unsupported = TileUrlTemplate(wms_url).unsupported
+    if len(missingparams) == 0 and len(unsupported) > 0:
+        warning_msgs.append(
+            "GetMap request not tested, unsupported placeholders in url: {}".format(
+                ",".join(sorted(unsupported))
+            )
+        )
+    elif len(missingparams) == 0:
+        try:
+            getmap_error, getmap_info = await check_wms_getmap(
+                source, wms_args, session, headers
+            )
+            if getmap_error is not None:
+                error_msgs.append(getmap_error)
+            info_msgs.extend(getmap_info)
+        except Exception as e:
+            error_msgs.append("GetMap request failed: Exception: {}".format(str(e)))
+
     # Check formats
     imagery_format = wms_args["format"]
     imagery_formats_str = "', '".join(wms["formats"])
@@ -802,61 +1811,16 @@ async def check_wms_endpoint(source, session: ClientSession):
     for k, v in parse_qsl(u.query, keep_blank_values=True):
         wms_args[k.lower()] = v
 
-    def get_getcapabilitie_url(wms_version=None, parameter_uppercase=False):
-
-        get_capabilities_args = {"service": "WMS", "request": "GetCapabilities"}
-        if wms_version is not None:
-            get_capabilities_args["version"] = wms_version
-
-        # Keep extra arguments, such as map or key
-        for key in wms_args:
-            if key not in {
-                "version",
-                "request",
-                "layers",
-                "bbox",
-                "width",
-                "height",
-                "format",
-                "crs",
-                "srs",
-                "styles",
-                "transparent",
-                "dpi",
-                "map_resolution",
-                "format_options",
-            }:
-                get_capabilities_args[key] = wms_args[key]
-
-        parameters = get_capabilities_args.items()
-        if parameter_uppercase:
-            parameters = [(k.upper(), v) for k, v in parameters]
-        else:
-            parameters = [(k.lower(), v) for k, v in parameters]
-        url_parts[4] = urlencode(parameters)
-        return urlunparse(url_parts)
-
-    for parameter_uppercase in [True, False]:
-        for wmsversion in [None, "1.3.0", "1.1.1", "1.1.0", "1.0.0"]:
-            try:
-                url = get_getcapabilitie_url(
-                    wms_version=wmsversion, parameter_uppercase=parameter_uppercase
-                )
-                response = await get_url(url, session, with_text=True, headers=headers)
-                if response.exception is not None:
-                    error_msgs.append(response.exception)
-                    return info_msgs, warning_msgs, error_msgs
-                xml = response.text
-                wms = parse_wms(xml)
-                for access_constraint in wms["AccessConstraints"]:
-                    info_msgs.append(
-                        "WMS AccessConstraints: {}".format(access_constraint)
-                    )
-                for fee in wms["Fees"]:
-                    info_msgs.append("WMS Fees: {}".format(fee))
-                break
-            except Exception as e:
-                error_msgs.append("Exception: {}".format(str(e)))
+    wms, exceptions = await get_wms_capabilities(
+        url_parts, wms_args, session, headers, stop_on_exception=True
+    )
+    if wms is None:
+        error_msgs.extend(exceptions)
+    else:
+        for access_constraint in wms["AccessConstraints"]:
+            info_msgs.append("WMS AccessConstraints: {}".format(access_constraint))
+        for fee in wms["Fees"]:
+            info_msgs.append("WMS Fees: {}".format(fee))
 
     return info_msgs, warning_msgs, error_msgs
 
@@ -893,16 +1857,14 @@ async def check_wmts(source, session):
         if not validators.url(wmts_url):
             error_msgs.append("URL validation error: {}".format(wmts_url))
 
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            response = await get_url(wmts_url, session, with_text=True, headers=headers)
-            if response.exception is not None:
-                error_msgs.append(response.exception)
-                return info_msgs, warning_msgs, error_msgs
+        response, wmts = await get_parsed_url(
+            wmts_url, session, parse_wmts, headers=headers
+        )
+        if response.exception is not None:
+            error_msgs.append(response.exception)
+            return info_msgs, warning_msgs, error_msgs
 
-            xml = response.text
-            wmts = WebMapTileService(wmts_url, xml=xml.encode("utf-8"))
-            info_msgs.append("Good")
+        info_msgs.append("Good")
     except Exception as e:
         error_msgs.append("Exception: {}".format(str(e)))
 
@@ -947,6 +1909,7 @@ async def process_source(filename, session: ClientSession):
     result["id"] = source_id
 
     # Check licence url
+    trace_tags.set({"source": source_id, "check": "license"})
     if "license_url" not in source["properties"]:
         result["license_url"] = create_result(ResultStatus.ERROR, "No license_url set!")
     else:
@@ -955,6 +1918,7 @@ async def process_source(filename, session: ClientSession):
         result["license_url"] = licence_url_status
 
     # Check privacy url
+    trace_tags.set({"source": source_id, "check": "privacy"})
     if "privacy_policy_url" not in source["properties"]:
         result["privacy_policy_url"] = create_result(
             ResultStatus.ERROR, "No privacy_policy_url set!"
@@ -988,6 +1952,7 @@ async def process_source(filename, session: ClientSession):
             info_msgs = error_msgs = []
             warning_msgs = ["Not checked, URL includes User-Agent"]
         else:
+            trace_tags.set({"source": source_id, "check": source["properties"]["type"]})
             if source["properties"]["type"] == "tms":
                 info_msgs, warning_msgs, error_msgs = await check_tms(source, session)
             elif source["properties"]["type"] == "wms":
@@ -1027,36 +1992,94 @@ async def process_source(filename, session: ClientSession):
     return result
 
 
-async def process(eli_path):
+def get_source_host(filename):
+    """Host of the imagery url of a source file, used to interleave the sources by host"""
+    try:
+        with open(filename) as f:
+            source = json.load(f)
+        return urlparse(source["properties"]["url"]).netloc.lower()
+    except Exception:
+        return None
+
+
+async def process(eli_path, cache_dir=None, executor="thread", cpu_workers=None):
     """Search for all sources files and setup of processing chain
 
     Parameters
     ----------
     eli_path : str
         Path to the 'sources' directory of the editor-layer-index
+    cache_dir : str
+        Directory of the persistent cache. If None, no persistent cache is used.
+    executor : str
+        Kind of pool CPU bound work is run in, see CPU_EXECUTORS
+    cpu_workers : int
+        Number of workers of the pool, defaults to the number of CPUs
     """
+    if cache_dir is not None:
+        http_cache.load(os.path.join(cache_dir, "http"))
+        wms_variants.load(os.path.join(cache_dir, "wms_variants.json"))
+        parsed_store.load(os.path.join(cache_dir, "capabilities"))
+        tile_fingerprints.load(os.path.join(cache_dir, "tile_fingerprints.json"))
+
     headers = {
         "User-Agent": "Mozilla/5.0 (compatible; MSIE 6.0; ELI Watchdog https://github.com/rbuffat/eli_watchdog )"
     }
     timeout = aiohttp.ClientTimeout(total=30)
 
-    async with ClientSession(headers=headers, timeout=timeout) as session:
-        jobs = []
-        for filename in glob.glob(
-            os.path.join(eli_path, "**", "*.geojson"), recursive=True
-        ):
-            jobs.append(process_source(filename, session))
-        result = await asyncio.gather(*jobs)
-        return result
+    connector = aiohttp.TCPConnector(limit=MAX_INFLIGHT_REQUESTS)
+    cpu_executor.start(executor, cpu_workers)
+    try:
+        async with ClientSession(
+            headers=headers,
+            timeout=timeout,
+            connector=connector,
+            trace_configs=[request_tracer.trace_config()],
+        ) as session:
+            filenames = glob.glob(
+                os.path.join(eli_path, "**", "*.geojson"), recursive=True
+            )
+            # Sources in glob order are clustered by country and hence by host. They are processed interleaved
+            # by host, the results are returned in glob order.
+            order = list(
+                interleave(
+                    range(len(filenames)),
+                    lambda index: get_source_host(filenames[index]),
+                )
+            )
+            results = await run_jobs(
+                order,
+                lambda index: process_source(filenames[index], session),
+                workers=MAX_WORKERS,
+            )
+            result = [None] * len(filenames)
+            for index, source_result in zip(order, results):
+                result[index] = source_result
+    finally:
+        cpu_executor.shutdown()
+
+    http_cache.save()
+    wms_variants.save()
+    parsed_store.save()
+    tile_fingerprints.save()
+    return result
 
 
-def fetch(eli_path):
+def fetch(eli_path, cache_dir=None, executor="thread", cpu_workers=None):
     """Fetch results of all sources
 
     Parameters
     ----------
     eli_path : str
         Path to the 'sources' directory of the editor-layer-index
+    cache_dir : str
+        Directory of the persistent cache. If None, no persistent cache is used.
+    executor : str
+        Kind of pool CPU bound work is run in, see CPU_EXECUTORS
+    cpu_workers : int
+        Number of workers of the pool, defaults to the number of CPUs
+
+    The timings of all requests are written to timings_report.
 
     Returns
     -------
@@ -1064,4 +2087,13 @@ def fetch(eli_path):
         A list with all results
 
     """
-    return asyncio.run(process(eli_path=eli_path))
+    result = asyncio.run(
+        process(
+            eli_path=eli_path,
+            cache_dir=cache_dir,
+            executor=executor,
+            cpu_workers=cpu_workers,
+        )
+    )
+    request_tracer.write_report(timings_report)
+    return result
@@ -0,0 +1,201 @@
+import asyncio
+import functools
+import multiprocessing
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+DEFAULT_WORKERS = 64
+# Kinds of executors for CPU bound work, "inline" runs the work directly on the event loop
+CPU_EXECUTORS = ["process", "thread", "inline"]
+
+
+def interleave(items, key):
+    """Order items round-robin over the groups given by key
+
+    In each round one item of every group that has items left is taken, groups with more remaining items first.
+    Like this the largest group, which determines the total run time when its items can not be processed in
+    parallel, starts as early as possible and its items are spread over the whole run.
+
+    Parameters
+    ----------
+    items : iterable
+        Items to order
+    key : callable
+        Function returning the group of an item, e.g. the host
+
+    Returns
+    -------
+    generator:
+        Items in interleaved order
+    """
+    groups = defaultdict(deque)
+    for item in items:
+        groups[key(item)].append(item)
+
+    queues = list(groups.values())
+    while len(queues) > 0:
+        queues.sort(key=len, reverse=True)
+        for queue in queues:
+            yield queue.popleft()
+        queues = [queue for queue in queues if len(queue) > 0]
+
+
+async def run_jobs(items, handler, workers=DEFAULT_WORKERS, queue_size=None):
+    """Process items with a fixed pool of workers
+
+    Items are fed through a bounded queue. The producer waits as long as the queue is full, thus at most
+    workers + queue_size items are in memory at the same time. If a job raises an exception, all other jobs are
+    cancelled and the exception is propagated.
+
+    Parameters
+    ----------
+    items : iterable
+        Items to process, can be a generator
+    handler : async callable
+        Coroutine function called with each item
+    workers : int
+        Number of workers
+    queue_size : int
+        Size of the queue, defaults to the number of workers
+
+    Returns
+    -------
+    list:
+        Results of handler in the order of items
+    """
+    if queue_size is None:
+        queue_size = workers
+    queue = asyncio.Queue(maxsize=queue_size)
+    results = {}
+
+    async def produce():
+        for index, item in enumerate(items):
+            await queue.put((index, item))
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def work():
+        while True:
+            job = await queue.get()
+            if job is None:
+                return
+            index, item = job
+            results[index] = await handler(item)
+
+    tasks = [asyncio.create_task(produce())]
+    tasks += [asyncio.create_task(work()) for _ in range(workers)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return [results[index] for index in sorted(results)]
+
+
+class CpuExecutor:
+    """Run CPU bound functions in a pool such that the event loop is not blocked
+
+    With a process pool, functions, their arguments and results must be picklable, thus functions must be
+    defined at module level. Worker processes are spawned instead of forked, as forking a process with a running
+    event loop and threads is unsafe. Thus the main module must be importable without side effects, i.e. guarded
+    by if __name__ == "__main__". As long as start() is not called, functions are run inline.
+    """
+
+    def __init__(self):
+        self.kind = "inline"
+        self.executor = None
+
+    def start(self, kind="thread", workers=None):
+        """Create the pool
+
+        Parameters
+        ----------
+        kind : str
+            One of CPU_EXECUTORS
+        workers : int
+            Number of workers, defaults to the default of the executor
+        """
+        if kind not in CPU_EXECUTORS:
+            raise ValueError("Unknown executor: {}".format(kind))
+        self.shutdown()
+        self.kind = kind
+        if kind == "process":
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        elif kind == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in the pool and return its result"""
+        if self.executor is None:
+            return func(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs)
+        )
+
+
+async def probe_in_order(candidates, probe, window):
+    """Probe candidates in order of preference until one succeeds, up to window probes at once
+
+    Candidates after the first candidate are probed speculatively while earlier ones are still running. Once a
+    probe succeeds, the probes of later candidates are cancelled and their results discarded, such that the
+    result is the same as if the candidates were probed one after another.
+
+    Parameters
+    ----------
+    candidates : list
+        Candidates in order of preference
+    probe : async callable
+        Coroutine function called with a candidate, returning whether the probe succeeded
+    window : int
+        Maximal number of probes running at once
+
+    Returns
+    -------
+    list:
+        (candidate, result) of the candidates up to and including the first successful one
+    """
+    window = max(window, 1)
+    tasks = {}
+    results = {}
+    next_index = 0
+    first_success = None
+    try:
+        while True:
+            while (
+                first_success is None
+                and next_index < len(candidates)
+                and len(tasks) < window
+            ):
+                task = asyncio.create_task(probe(candidates[next_index]))
+                tasks[task] = next_index
+                next_index += 1
+            if len(tasks) == 0:
+                break
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = tasks.pop(task)
+                results[index] = task.result()
+                if results[index] and (first_success is None or index < first_success):
+                    first_success = index
+            if first_success is not None:
+                for task, index in list(tasks.items()):
+                    if index > first_success:
+                        task.cancel()
+                        del tasks[task]
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    last = len(candidates) - 1 if first_success is None else first_success
+    return [(candidates[index], results[index]) for index in range(last + 1)]
@@ -0,0 +1,413 @@
+import json
+import math
+import os
+import re
+
+import mercantile
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+# Placeholders of tile urls, e.g. {zoom} or {switch:a,b,c}
+PLACEHOLDER_PATTERN = re.compile(r"{([^{}]*)}")
+
+# Tile size in pixels used for {width} and {height}
+TILE_SIZE = 256
+
+# Latitude limit of the web mercator projection
+MAX_LATITUDE = 85.0511287798066
+
+
+def render_bbox(zoom, x, y):
+    """Bounds of a tile in EPSG:3857 as minx,miny,maxx,maxy"""
+    bounds = mercantile.xy_bounds(x, y, zoom)
+    return "{},{},{},{}".format(bounds.left, bounds.bottom, bounds.right, bounds.top)
+
+
+# Functions rendering a placeholder from zoom, x and y of a tile
+TILE_PLACEHOLDERS = {
+    "zoom": lambda zoom, x, y: str(zoom),
+    "x": lambda zoom, x, y: str(x),
+    "y": lambda zoom, x, y: str(y),
+    "-y": lambda zoom, x, y: str(2**zoom - 1 - y),
+    "!y": lambda zoom, x, y: str(2**zoom // 2 - 1 - y),
+    "u": lambda zoom, x, y: mercantile.quadkey(x, y, zoom),
+    "bbox": render_bbox,
+    "proj": lambda zoom, x, y: "EPSG:3857",
+    "width": lambda zoom, x, y: str(TILE_SIZE),
+    "height": lambda zoom, x, y: str(TILE_SIZE),
+}
+
+
+class TileUrlTemplate:
+    """Tile url of an ELI source compiled once to render the urls of many tiles
+
+    The url is split into literal parts and placeholders. Supported placeholders are listed in
+    TILE_PLACEHOLDERS, plus {switch:a,b,c} which is rendered with one of its alternatives.
+
+    Attributes
+    ----------
+    url : str
+        The template
+    switches : list of str
+        Alternatives of {switch:...}, empty if the template has no switch
+    placeholders : set of str
+        Names of all placeholders, "switch" for {switch:...}
+    unsupported : set of str
+        Names of placeholders that can not be rendered, e.g. apikey
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.switches = []
+        self.placeholders = set()
+        # Literal parts at even, placeholder names at odd positions
+        self.parts = []
+
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(url):
+            name = match.group(1)
+            if name.startswith("switch:"):
+                self.switches = name[len("switch:") :].split(",")
+                name = "switch"
+            self.parts.append(url[position : match.start()])
+            self.parts.append(name)
+            self.placeholders.add(name)
+            position = match.end()
+        self.parts.append(url[position:])
+
+        self.unsupported = {
+            name
+            for name in self.placeholders
+            if name not in TILE_PLACEHOLDERS and not name == "switch"
+        }
+
+    def validation_url(self):
+        """Url with the placeholders replaced by their names, e.g. to validate the url"""
+        return "".join(self.parts)
+
+    def render(self, zoom, x, y, switch=None):
+        """Url of the tile zoom/x/y
+
+        Parameters
+        ----------
+        zoom, x, y : int
+            Tile coordinates, y counted from the top as in the XYZ scheme
+        switch : str
+            Alternative used for {switch:...}, defaults to the first one
+
+        Raises
+        ------
+        ValueError
+            If the template contains unsupported placeholders
+        """
+        if len(self.unsupported) > 0:
+            raise ValueError(
+                "Unsupported placeholders: {}".format(
+                    ",".join(sorted(self.unsupported))
+                )
+            )
+        if switch is None and len(self.switches) > 0:
+            switch = self.switches[0]
+
+        parts = self.parts[:]
+        for i in range(1, len(parts), 2):
+            if parts[i] == "switch":
+                parts[i] = switch
+            else:
+                parts[i] = TILE_PLACEHOLDERS[parts[i]](zoom, x, y)
+        return "".join(parts)
+
+    def render_values(self, values, switch=None):
+        """Url with the placeholders replaced by values, e.g. for WMS urls
+
+        Parameters
+        ----------
+        values : dict
+            Rendered value of each placeholder except switch
+        switch : str
+            Alternative used for {switch:...}, defaults to the first one
+        """
+        if switch is None and len(self.switches) > 0:
+            switch = self.switches[0]
+
+        parts = self.parts[:]
+        for i in range(1, len(parts), 2):
+            if parts[i] == "switch":
+                parts[i] = switch
+            else:
+                parts[i] = values[parts[i]]
+        return "".join(parts)
+
+
+# Projections in which the bounding box of a GetMap request can be computed, in order of preference
+GETMAP_PROJECTIONS = ["EPSG:3857", "EPSG:900913", "EPSG:4326", "CRS:84"]
+
+
+def render_getmap_bbox(lon, lat, zoom, size, proj, lat_lon_order=False):
+    """Bounding box of a GetMap request for an image of size x size pixels centered at lon, lat
+
+    The resolution of the image is the resolution of tiles at zoom, such that layers restricted to scale ranges
+    are rendered as in a tile at zoom.
+
+    Parameters
+    ----------
+    lon, lat : float
+        Center of the image in EPSG:4326
+    zoom : int
+        Zoom level whose resolution is used
+    size : int
+        Width and height of the image in pixels
+    proj : str
+        One of GETMAP_PROJECTIONS
+    lat_lon_order : bool
+        Whether the axis order of proj is latitude, longitude. This is the case for EPSG:4326 in WMS 1.3.0.
+
+    Returns
+    -------
+    str:
+        Bounding box as comma separated coordinates
+    """
+    lat = min(max(lat, -MAX_LATITUDE), MAX_LATITUDE)
+    x, y = mercantile.xy(lon, lat)
+    resolution = 2 * math.pi * 6378137 / TILE_SIZE / 2**zoom
+    half = size / 2 * resolution
+    minx, miny, maxx, maxy = x - half, y - half, x + half, y + half
+    if proj in {"EPSG:3857", "EPSG:900913"}:
+        values = [minx, miny, maxx, maxy]
+    else:
+        west, south = mercantile.lnglat(minx, miny)
+        east, north = mercantile.lnglat(maxx, maxy)
+        if lat_lon_order:
+            values = [south, west, north, east]
+        else:
+            values = [west, south, east, north]
+    return ",".join(str(value) for value in values)
+
+
+def tile_coordinates(lons, lats, zoom):
+    """Vectorized mercantile.tile(): x and y of the tiles containing the points at zoom
+
+    Parameters
+    ----------
+    lons, lats : array_like
+        Coordinates of the points in EPSG:4326
+    zoom : int
+        Zoom level
+
+    Returns
+    -------
+    numpy.ndarray:
+        x of the tiles
+    numpy.ndarray:
+        y of the tiles, counted from the top
+    """
+    n = 2**zoom
+    lons = np.asarray(lons, dtype=float)
+    lats = np.radians(
+        np.clip(np.asarray(lats, dtype=float), -MAX_LATITUDE, MAX_LATITUDE)
+    )
+    xs = np.floor((lons + 180.0) / 360.0 * n)
+    ys = np.floor((1.0 - np.arcsinh(np.tan(lats)) / math.pi) / 2.0 * n)
+    return (
+        np.clip(xs, 0, n - 1).astype(np.int64),
+        np.clip(ys, 0, n - 1).astype(np.int64),
+    )
+
+
+def sample_points(geometry, count):
+    """Sample up to count points spread over a GeoJSON geometry
+
+    The first point is the representative point of the geometry. The others are centers of the cells of a
+    regular grid over the bounds of the geometry that lie within the geometry, evenly picked from all such
+    cells. The points are deterministic, such that the same tiles are requested in every run.
+
+    Returns
+    -------
+    list of tuple:
+        (lon, lat) of the points
+    """
+    geom = shape(geometry)
+    point = geom.representative_point()
+    points = [(point.x, point.y)]
+    if count <= 1 or geom.is_empty:
+        return points
+
+    # Grid with about four cells per requested point
+    size = math.ceil(math.sqrt(4 * count))
+    minx, miny, maxx, maxy = geom.bounds
+    xs = minx + (np.arange(size) + 0.5) * (maxx - minx) / size
+    ys = miny + (np.arange(size) + 0.5) * (maxy - miny) / size
+    grid_x, grid_y = (values.ravel() for values in np.meshgrid(xs, ys))
+    inside = shapely.contains_xy(geom, grid_x, grid_y)
+    grid_x, grid_y = grid_x[inside], grid_y[inside]
+
+    picked = min(count - 1, len(grid_x))
+    if picked > 0:
+        indices = np.linspace(0, len(grid_x) - 1, picked).round().astype(int)
+        points += [(float(grid_x[i]), float(grid_y[i])) for i in indices]
+    return points
+
+
+# Minimal width and height of a tile in pixels. Smaller images are placeholders, e.g. transparent 1x1 pixels.
+MIN_TILE_SIZE = 64
+
+# Content types of tiles besides image/*
+TILE_CONTENT_TYPES = {"application/octet-stream", "binary/octet-stream"}
+
+
+def sniff_jpeg_size(data):
+    """Width and height from the SOF segment of a JPEG, None if not within data"""
+    position = 2
+    while position + 9 <= len(data):
+        if not data[position] == 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # Fill byte
+            position += 1
+            continue
+        if marker in {0x01, *range(0xD0, 0xD8)}:
+            # Markers without segment
+            position += 2
+            continue
+        length = int.from_bytes(data[position + 2 : position + 4], "big")
+        # Start of frame, except DHT, JPG and DAC which share the range
+        if 0xC0 <= marker <= 0xCF and marker not in {0xC4, 0xC8, 0xCC}:
+            height = int.from_bytes(data[position + 5 : position + 7], "big")
+            width = int.from_bytes(data[position + 7 : position + 9], "big")
+            return width, height
+        position += 2 + length
+    return None
+
+
+def sniff_image(data):
+    """Detect format and size of an image from its first bytes
+
+    Supports PNG (IHDR), JPEG (SOF), WebP (VP8, VP8L, VP8X) and GIF. The size of a JPEG is None if its SOF
+    segment is not within data, e.g. due to large metadata.
+
+    Returns
+    -------
+    tuple or None:
+        (format, width, height) or None if data is not the start of a supported image
+    """
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        if len(data) >= 24 and data[12:16] == b"IHDR":
+            width = int.from_bytes(data[16:20], "big")
+            height = int.from_bytes(data[20:24], "big")
+            return "png", width, height
+        return None
+    if data.startswith(b"\xff\xd8\xff"):
+        size = sniff_jpeg_size(data)
+        if size is None:
+            return "jpeg", None, None
+        return ("jpeg", *size)
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        chunk = data[12:16]
+        if chunk == b"VP8 " and len(data) >= 30 and data[23:26] == b"\x9d\x01\x2a":
+            width = int.from_bytes(data[26:28], "little") & 0x3FFF
+            height = int.from_bytes(data[28:30], "little") & 0x3FFF
+            return "webp", width, height
+        if chunk == b"VP8L" and len(data) >= 25 and data[20] == 0x2F:
+            bits = int.from_bytes(data[21:25], "little")
+            return "webp", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X" and len(data) >= 30:
+            width = int.from_bytes(data[24:27], "little") + 1
+            height = int.from_bytes(data[27:30], "little") + 1
+            return "webp", width, height
+        return None
+    if data[:6] in {b"GIF87a", b"GIF89a"} and len(data) >= 10:
+        width = int.from_bytes(data[6:8], "little")
+        height = int.from_bytes(data[8:10], "little")
+        return "gif", width, height
+    return None
+
+
+def validate_tile(data, content_type):
+    """Check the first bytes and the content type of a tile
+
+    Returns
+    -------
+    str or None:
+        Reason why data is not a valid tile, None if it is valid
+    """
+    if content_type is not None:
+        content_type = content_type.split(";")[0].strip().lower()
+        if not (
+            content_type.startswith("image/") or content_type in TILE_CONTENT_TYPES
+        ):
+            return "Content-Type '{}' is not an image".format(content_type)
+    image = sniff_image(data)
+    if image is None:
+        return "Response is not a PNG, JPEG, WebP or GIF image"
+    image_format, width, height = image
+    if width is not None and (width < MIN_TILE_SIZE or height < MIN_TILE_SIZE):
+        return "Image of {}x{} pixels is too small for a tile".format(width, height)
+    return None
+
+
+# Number of different tiles of a host with the same fingerprint, from which on the fingerprint is considered to
+# be the one of a placeholder tile, e.g. a "no data" or watermark tile
+PLACEHOLDER_MIN_TILES = 3
+
+
+class TileFingerprints:
+    """Persistent store of the fingerprints of tiles per host to detect placeholder tiles
+
+    The fingerprint of a tile is the digest of its first bytes together with the size of the whole tile. A
+    fingerprint seen for at least PLACEHOLDER_MIN_TILES different tiles of a host is a placeholder. Placeholders
+    are only decided from the fingerprints loaded from a previous run, such that the outcome of a run does not
+    depend on the order in which its tiles arrive. For every fingerprint at most PLACEHOLDER_MIN_TILES tile urls
+    are kept. As long as no path is set with load(), no tile is a placeholder.
+    """
+
+    def __init__(self, min_tiles=PLACEHOLDER_MIN_TILES):
+        self.path = None
+        self.min_tiles = min_tiles
+        # host -> fingerprint -> list of tile urls
+        self.hosts = {}
+        self.used = set()
+        # (host, fingerprint) of the placeholders known from the previous run
+        self.placeholders = set()
+
+    def load(self, path):
+        """Load fingerprints from the JSON file path"""
+        self.path = path
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.hosts = json.load(f)
+            except Exception as e:
+                print("Could not load tile fingerprints {}: {}".format(path, str(e)))
+                self.hosts = {}
+        self.placeholders = {
+            (host, fingerprint)
+            for host, fingerprints in self.hosts.items()
+            for fingerprint, urls in fingerprints.items()
+            if len(urls) >= self.min_tiles
+        }
+
+    def save(self):
+        """Write the fingerprints of placeholders and of the tiles seen during this run to disk"""
+        if self.path is None:
+            return
+        hosts = {}
+        for host, fingerprints in self.hosts.items():
+            kept = {
+                fingerprint: urls
+                for fingerprint, urls in fingerprints.items()
+                if (host, fingerprint) in self.used or len(urls) >= self.min_tiles
+            }
+            if len(kept) > 0:
+                hosts[host] = kept
+        with open(self.path, "w") as f:
+            json.dump(hosts, f)
+
+    def add(self, host, fingerprint, url):
+        """Record the fingerprint of the tile url and return whether it is a placeholder of a previous run"""
+        self.used.add((host, fingerprint))
+        urls = self.hosts.setdefault(host, {}).setdefault(fingerprint, [])
+        if url not in urls and len(urls) < self.min_tiles:
+            urls.append(url)
+        return (host, fingerprint) in self.placeholders
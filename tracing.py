@@ -0,0 +1,121 @@
+import contextvars
+import json
+import time
+from collections import defaultdict
+
+import aiohttp
+
+# Tags of the requests sent in the current context, e.g. {"source": "id", "check": "wms"}
+trace_tags = contextvars.ContextVar("trace_tags", default={})
+
+
+class RequestTracer:
+    """Record timings of all requests sent by get_url()
+
+    get_url() creates a record with new_record() and passes it as trace_request_ctx to the request. The callbacks
+    of trace_config() fill in the timestamps of the phases of the request. finish() computes the durations of the
+    phases and stores the record:
+
+    wait: Waiting for the HostLimiter and the global request limit
+    queued: Waiting for a free connection of the connector
+    dns: DNS resolution
+    connect: Establishing the connection, including the TLS handshake (aiohttp does not trace TLS separately)
+    ttfb: Time until the response headers are received after the connection is ready
+    body: Reading the body
+    """
+
+    def __init__(self):
+        self.records = []
+        self.started = time.monotonic()
+
+    def new_record(self, url, host, method):
+        record = {"url": url, "host": host, "method": method}
+        record.update(trace_tags.get())
+        record["created"] = time.monotonic()
+        return record
+
+    def trace_config(self):
+        """TraceConfig to attach to the ClientSession"""
+
+        def stamp(name):
+            async def callback(session, ctx, params):
+                record = ctx.trace_request_ctx
+                if isinstance(record, dict):
+                    record[name] = time.monotonic()
+
+            return callback
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(stamp("request_start"))
+        trace_config.on_connection_queued_start.append(stamp("queued_start"))
+        trace_config.on_connection_queued_end.append(stamp("queued_end"))
+        trace_config.on_dns_resolvehost_start.append(stamp("dns_start"))
+        trace_config.on_dns_resolvehost_end.append(stamp("dns_end"))
+        trace_config.on_connection_create_start.append(stamp("connect_start"))
+        trace_config.on_connection_create_end.append(stamp("connect_end"))
+        trace_config.on_connection_reuseconn.append(stamp("reused"))
+        trace_config.on_request_end.append(stamp("request_end"))
+        trace_config.on_request_exception.append(stamp("request_end"))
+        return trace_config
+
+    def finish(self, record, status=None, exception=None):
+        """Compute the durations of the phases of record and store it"""
+        end = time.monotonic()
+
+        def duration(start, stop):
+            if start in record and stop in record:
+                return round(record[stop] - record[start], 4)
+            return None
+
+        request_start = record.get("request_start", end)
+        if "connect_end" in record:
+            connection_ready = record["connect_end"]
+        elif "queued_end" in record:
+            connection_ready = record["queued_end"]
+        else:
+            connection_ready = request_start
+        headers_received = record.get("request_end", end)
+
+        self.records.append(
+            {
+                "url": record["url"],
+                "host": record["host"],
+                "method": record["method"],
+                "source": record.get("source"),
+                "check": record.get("check"),
+                "status": status,
+                "exception": exception,
+                "start": round(record["created"] - self.started, 4),
+                "wait": round(request_start - record["created"], 4),
+                "queued": duration("queued_start", "queued_end"),
+                "dns": duration("dns_start", "dns_end"),
+                "connect": duration("connect_start", "connect_end"),
+                "reused": "reused" in record,
+                "ttfb": round(headers_received - connection_ready, 4),
+                "body": round(end - headers_received, 4),
+                "total": round(end - record["created"], 4),
+            }
+        )
+
+    def summary(self, key):
+        """Sum of request count and durations grouped by key, e.g. 'host' or 'check'"""
+        groups = defaultdict(lambda: {"requests": 0, "total": 0.0, "wait": 0.0})
+        for record in self.records:
+            group = groups[record[key]]
+            group["requests"] += 1
+            group["total"] += record["total"]
+            group["wait"] += record["wait"]
+        return dict(
+            sorted(groups.items(), key=lambda item: item[1]["total"], reverse=True)
+        )
+
+    def write_report(self, path):
+        """Write all records and summaries per host and check as JSON to path"""
+        report = {
+            "duration": round(time.monotonic() - self.started, 4),
+            "hosts": self.summary("host"),
+            "checks": self.summary("check"),
+            "requests": self.records,
+        }
+        with open(path, "w") as f:
+            json.dump(report, f, indent=1)
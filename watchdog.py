@@ -1,14 +1,38 @@
 import renderer
 from query import fetch
+from scheduler import CPU_EXECUTORS
 import argparse
 import notify
 
-parser = argparse.ArgumentParser()
-parser.add_argument("path")
-args = parser.parse_args()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument(
+        "--cache-dir",
+        default="cache",
+        help="Directory of the cache persisted between runs",
+    )
+    parser.add_argument(
+        "--executor",
+        choices=CPU_EXECUTORS,
+        default="thread",
+        help="Pool in which CPU bound parsing and geometry work is run, process to use all CPUs",
+    )
+    parser.add_argument(
+        "--cpu-workers",
+        type=int,
+        default=None,
+        help="Number of workers of the pool, defaults to the number of CPUs",
+    )
+    args = parser.parse_args()
 
-eli_path = args.path
+    eli_path = args.path
 
-results = fetch(eli_path)
-renderer.render(results)
-notify.notify_broken_imagery(results)
+    results = fetch(
+        eli_path,
+        cache_dir=args.cache_dir,
+        executor=args.executor,
+        cpu_workers=args.cpu_workers,
+    )
+    renderer.render(results)
+    notify.notify_broken_imagery(results)